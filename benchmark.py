@@ -0,0 +1,402 @@
+# This file benchmarks the loader transforms and dashboard computations on synthetic data
+
+
+import argparse
+import datetime
+import gzip
+import json
+import math
+import os
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, TypedDict
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+import pandas as pd
+
+# How big each source is today. Every benchmark is run at multiples of this
+BASE_SIZES = {
+    'brex_transactions': 3_000,
+    'brex_statements': 24,
+    'stripe_subscriptions': 500,
+    'team_customers': 20,
+    'mixpanel_profiles_per_month': 1_000,
+    'mixpanel_months': 12,
+    'mixpanel_events': 50_000,
+    'notion_pages': 200,
+}
+DEFAULT_SCALES = [1, 10, 100]
+SEED = 0
+
+# Page sizes the real APIs use
+BREX_PAGE_SIZE = 100
+MIXPANEL_PAGE_SIZE = 1_000
+MIXPANEL_EXPORT_BATCH_SIZE = 10_000
+NOTION_PAGE_SIZE = 100
+
+STAND_IN_ACCOUNT_ID = 'cash_account'
+STAND_IN_DATABASE_ID = 'notion_database'
+
+
+def get_rng(*key: int) -> np.random.Generator:
+    # Every page is generated from its own seed, so the stand-in server can serve any page without holding the rest
+    return np.random.default_rng((SEED,) + key)
+
+def generate_brex_transactions(start: int, stop: int) -> List[Dict[str, Any]]:
+    rng = get_rng(0, start)
+    n = stop - start
+    descriptions = np.array(['STRIPE - TRANSFER', 'RIPPLING - PAYROLL', 'AWS - SERVICES', 'GUSTO - PAYROLL', 'ACME CORP - INVOICE', 'GOOGLE - WORKSPACE'])
+    posted = pd.Timestamp('2021-01-01') + pd.to_timedelta(rng.integers(0, 365 * 3, n), unit='D')
+    amounts = rng.normal(0, 2_000_000, n).round().astype('int64')
+    return [
+        {
+            'id': f'dpte_{start + i}',
+            'description': description,
+            'amount': {'amount': int(amount), 'currency': 'USD'},
+            'initiated_at_date': date,
+            'posted_at_date': date,
+            'type': 'PAYMENT',
+        }
+        for i, (description, amount, date) in enumerate(zip(rng.choice(descriptions, n), amounts, posted.strftime('%Y-%m-%d')))
+    ]
+
+def generate_brex_statements(start: int, stop: int) -> List[Dict[str, Any]]:
+    rng = get_rng(1, start)
+    statements = []
+    for i in range(start, stop):
+        period_start = pd.Timestamp('2000-01-01') + pd.DateOffset(months=i)
+        start_balance = int(rng.integers(100_000_000, 500_000_000))
+        statements.append({
+            'id': f'stmt_{i}',
+            'start_balance': {'amount': start_balance, 'currency': 'USD'},
+            'end_balance': {'amount': start_balance - int(rng.integers(-5_000_000, 20_000_000)), 'currency': 'USD'},
+            'period': {'start_date': period_start.strftime('%Y-%m-%d'), 'end_date': (period_start + pd.DateOffset(months=1, days=-1)).strftime('%Y-%m-%d')},
+        })
+    return statements
+
+def generate_mixpanel_profiles(cohort: int, start: int, stop: int) -> List[Dict[str, Any]]:
+    # Distinct ids are drawn from a pool that overlaps between months, so cohorts intersect like real retention
+    rng = get_rng(2, cohort, start)
+    n = stop - start
+    ids = rng.integers(0, max(1, 4 * n), n)
+    has_email = rng.random(n) < 0.6
+    return [
+        {'$distinct_id': f'user_{distinct_id}', '$properties': {'$email': f'user_{distinct_id}@example.com'} if email else {}}
+        for distinct_id, email in zip(ids, has_email)
+    ]
+
+def generate_mixpanel_events(start: int, stop: int) -> List[Dict[str, Any]]:
+    # A year of events from a pool of users, each seen on a handful of days, and a few signing up
+    rng = get_rng(7, start)
+    n = stop - start
+    ids = rng.integers(0, max(1, n // 10), n)
+    times = int(pd.Timestamp('2023-01-01').timestamp()) + rng.integers(0, 365 * 86400, n)
+    events = np.where(rng.random(n) < 0.02, 'finished_signup', 'mitosheet_opened')
+    return [
+        {'event': event, 'properties': {'time': int(time), 'distinct_id': f'user_{distinct_id}', '$os': 'Mac OS X', 'mp_lib': 'python'}}
+        for event, time, distinct_id in zip(events, times, ids)
+    ]
+
+def generate_notion_pages(start: int, stop: int) -> List[Dict[str, Any]]:
+    rng = get_rng(3, start)
+    pages = []
+    for i in range(start, stop):
+        date = (datetime.date(2022, 1, 1) + datetime.timedelta(days=int(rng.integers(0, 700)))).isoformat()
+        pages.append({
+            'id': f'page_{i}',
+            'last_edited_time': date + 'T00:00:00.000Z',
+            'properties': {
+                'Name': {'type': 'title', 'title': [{'text': {'content': f'Page {i}'}}]},
+                'Notes': {'type': 'rich_text', 'rich_text': [{'plain_text': 'Some '}, {'plain_text': 'notes'}]},
+                'Date': {'type': 'date', 'date': {'start': date}},
+                'Hours': {'type': 'number', 'number': float(rng.integers(0, 10))},
+                'Status': {'type': 'select', 'select': {'name': str(rng.choice(['Done', 'In Progress', 'Blocked']))}},
+                'Tags': {'type': 'multi_select', 'multi_select': [{'name': 'a'}, {'name': 'b'}]},
+                'Owner': {'type': 'people', 'people': [{'name': str(rng.choice(['Ann', 'Bo', 'Cy']))}]},
+                'Link': {'type': 'url', 'url': f'https://example.com/{i}'},
+            },
+        })
+    return pages
+
+NOTION_SCHEMA = {name: notion_property['type'] for name, notion_property in generate_notion_pages(0, 1)[0]['properties'].items()}
+
+def generate_stripe_subscriptions(n: int) -> pd.DataFrame:
+    # Shaped like STRIPE.SUBSCRIPTIONS as the dashboard reads it
+    rng = get_rng(4)
+    start_date = pd.Timestamp('2020-01-01') + pd.to_timedelta(rng.integers(0, 365 * 4 * 24 * 60, n), unit='min')
+    end_date = start_date + pd.to_timedelta(rng.integers(30 * 24 * 60, 365 * 8 * 24 * 60, n), unit='min')
+    return pd.DataFrame({'start_date': start_date, 'end_date': end_date, 'amount': rng.integers(10, 100, n).astype('float64')})
+
+def generate_team_customers(n: int) -> pd.DataFrame:
+    rng = get_rng(5)
+    start_date = pd.Timestamp('2021-01-01') + pd.to_timedelta(rng.integers(0, 365 * 3, n), unit='D')
+    return pd.DataFrame({
+        'name': [f'Team {i}' for i in range(n)],
+        'start_date': start_date,
+        'end_date': start_date + pd.to_timedelta(rng.integers(180, 365 * 5, n), unit='D'),
+        'monthly_amount': rng.integers(500, 5_000, n).astype('float64'),
+    })
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # Serves generated Brex, Mixpanel and Notion pages, paginated the way each API is
+    protocol_version = 'HTTP/1.1'
+    # Otherwise the body waits on the ACK for the headers, which adds 40ms to every page
+    disable_nagle_algorithm = True
+    server: 'StandInServer'
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def send_json(self, data: Any) -> None:
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body, compresslevel=1)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_jsonl(self, batches: Iterator[List[Dict[str, Any]]]) -> None:
+        # Compressed and sent in chunks as it is generated, like the export API, so neither side holds the whole body
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        compressor = zlib.compressobj(1, wbits=31)
+        for batch in batches:
+            self.send_chunk(compressor.compress(''.join(json.dumps(item) + '\n' for item in batch).encode()))
+        self.send_chunk(compressor.flush())
+        self.wfile.write(b'0\r\n\r\n')
+
+    def send_chunk(self, data: bytes) -> None:
+        # An empty chunk would end the body
+        if len(data) > 0:
+            self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def send_cursor_page(self, generate: Callable[[int, int], List[Dict[str, Any]]], total: int, cursor: Optional[str], page_size: int) -> None:
+        start = int(cursor) if cursor else 0
+        stop = min(start + page_size, total)
+        self.send_json({'items': generate(start, stop), 'next_cursor': str(stop) if stop < total else None})
+
+    def do_GET(self) -> None:
+        url = urlsplit(self.path)
+        cursor = parse_qs(url.query).get('cursor', [None])[0]
+        sizes = self.server.sizes
+        if url.path == f'/brex/transactions/cash/{STAND_IN_ACCOUNT_ID}':
+            self.send_cursor_page(generate_brex_transactions, sizes['brex_transactions'], cursor, BREX_PAGE_SIZE)
+        elif url.path == f'/brex/accounts/cash/{STAND_IN_ACCOUNT_ID}/statements':
+            self.send_cursor_page(generate_brex_statements, sizes['brex_statements'], cursor, BREX_PAGE_SIZE)
+        elif url.path == f'/notion/databases/{STAND_IN_DATABASE_ID}':
+            self.send_json({'properties': {name: {'type': property_type} for name, property_type in NOTION_SCHEMA.items()}})
+        elif url.path == '/mixpanel-export/export':
+            total = sizes['mixpanel_events']
+            self.send_jsonl(generate_mixpanel_events(start, min(start + MIXPANEL_EXPORT_BATCH_SIZE, total)) for start in range(0, total, MIXPANEL_EXPORT_BATCH_SIZE))
+        else:
+            self.send_error(404)
+
+    def do_POST(self) -> None:
+        url = urlsplit(self.path)
+        sizes = self.server.sizes
+        if url.path == '/mixpanel/engage':
+            # Mixpanel pages are numbered from 0, and later pages name the session of the first
+            form = parse_qs(self.read_body().decode())
+            page = int(form.get('page', ['0'])[0])
+            total = sizes['mixpanel_profiles_per_month']
+            start, stop = page * MIXPANEL_PAGE_SIZE, min((page + 1) * MIXPANEL_PAGE_SIZE, total)
+            self.send_json({'results': generate_mixpanel_profiles(0, start, stop), 'page': page, 'session_id': 'session', 'total': total})
+        elif url.path == f'/notion/databases/{STAND_IN_DATABASE_ID}/query':
+            body = json.loads(self.read_body() or b'{}')
+            start = int(body.get('start_cursor', 0))
+            stop = min(start + body.get('page_size', NOTION_PAGE_SIZE), sizes['notion_pages'])
+            self.send_json({'results': generate_notion_pages(start, stop), 'has_more': stop < sizes['notion_pages'], 'next_cursor': str(stop)})
+        else:
+            self.send_error(404)
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+    sizes: Dict[str, int] = {}
+
+def start_stand_in_server() -> StandInServer:
+    server = StandInServer(('127.0.0.1', 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class StandInSnowflakeCursor:
+    # Only answers the column lookup that load_df_into_table makes before it writes
+    def __init__(self, conn: 'StandInSnowflakeConnection'):
+        self.conn = conn
+        self.description: List[Tuple[str]] = []
+
+    def execute(self, sql: str, *args: Any, **kwargs: Any) -> 'StandInSnowflakeCursor':
+        if sql.endswith('LIMIT 0'):
+            self.description = [(column,) for column in self.conn.columns]
+        return self
+
+class StandInSnowflakeConnection:
+    def __init__(self, columns: List[str]):
+        self.columns = columns
+        self.staged_bytes = 0
+
+    def cursor(self) -> StandInSnowflakeCursor:
+        return StandInSnowflakeCursor(self)
+
+def stand_in_write_pandas(conn: StandInSnowflakeConnection, df: pd.DataFrame, table_name: str, chunk_size: int, compression: str, **kwargs: Any) -> Tuple[bool, int, int, List[Any]]:
+    # Does the local half of write_pandas, writing each chunk to a compressed Parquet file, and
+    # leaves out the upload. Only public pandas is used, so a new connector release can't break it
+    num_chunks = 0
+    with tempfile.TemporaryDirectory() as directory:
+        for start in range(0, len(df), chunk_size):
+            path = os.path.join(directory, f'{table_name}_{num_chunks}.parquet')
+            df.iloc[start:start + chunk_size].to_parquet(path, compression=compression, index=False)
+            conn.staged_bytes += os.path.getsize(path)
+            os.remove(path)
+            num_chunks += 1
+    return True, num_chunks, len(df), []
+
+
+class BenchmarkResult(TypedDict):
+    benchmark: str
+    scale: int
+    rows: int
+    seconds_min: float
+    seconds_median: float
+    peak_memory_bytes: int
+
+def run_benchmark(name: str, scale: int, setup: Callable[[], Any], run: Callable[[Any], int], repeat: int) -> BenchmarkResult:
+    # Timed runs don't trace allocations, since tracing slows them down; one more run measures the peak
+    seconds = []
+    for _ in range(repeat):
+        data = setup()
+        start = time.perf_counter()
+        rows = run(data)
+        seconds.append(time.perf_counter() - start)
+
+    data = setup()
+    tracemalloc.start()
+    run(data)
+    _, peak_memory_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'benchmark': name, 'scale': scale, 'rows': rows, 'seconds_min': min(seconds), 'seconds_median': statistics.median(seconds), 'peak_memory_bytes': peak_memory_bytes}
+
+def get_benchmarks(server: StandInServer, scale: int) -> Dict[str, Tuple[Callable[[], Any], Callable[[Any], int]]]:
+    import loader
+    import main
+
+    sizes = {name: size * scale for name, size in BASE_SIZES.items()}
+    # The retention table is months by months, so its side grows with the square root to keep the cells linear in scale
+    sizes['mixpanel_months'] = round(BASE_SIZES['mixpanel_months'] * math.sqrt(scale))
+
+    def set_sizes() -> None:
+        server.sizes = sizes
+
+    def get_users_in_time_periods() -> List[loader.UsersInTimePeriod]:
+        users_in_time_periods = []
+        n = sizes['mixpanel_profiles_per_month']
+        distinct_id_codes = loader.DistinctIdCodes()
+        for month in range(sizes['mixpanel_months']):
+            start_date = datetime.datetime(2023, 1, 1) + pd.DateOffset(months=month)
+            first_seen = loader.intern_profile_pages([generate_mixpanel_profiles(month, 0, n)], distinct_id_codes)
+            any_event = loader.intern_profile_pages([generate_mixpanel_profiles(month + 1000, 0, n)], distinct_id_codes)
+            users_in_time_periods.append(loader.build_users_in_time_period(start_date, start_date + pd.DateOffset(months=1, days=-1), first_seen, any_event))
+        return users_in_time_periods
+
+    def get_retention_table() -> pd.DataFrame:
+        # Shaped like MIXPANEL.RETENTION as the dashboard reads it
+        months = sizes['mixpanel_months']
+        start_dates = pd.date_range(end=pd.Timestamp.now().normalize().replace(day=1), periods=months, freq='MS')
+        counts = get_rng(6).integers(0, 1_000, (months, months))
+        retention_data = pd.DataFrame({'start_date': start_dates, 'end_date': start_dates + pd.DateOffset(months=1), 'initial_size': 1_000})
+        periods = pd.DataFrame(np.triu(counts), columns=[f'period_{d:%Y_%m_%d}' for d in start_dates])
+        return pd.concat([retention_data, periods], axis=1)
+
+    def get_activity_index_path() -> str:
+        set_sizes()
+        # Every run starts from an empty index, so it exports and indexes every event
+        return os.path.join(tempfile.mkdtemp(), 'mixpanel_activity.sqlite')
+
+    def get_brex_transaction_df() -> pd.DataFrame:
+        return loader.normalize_brex_transaction_page(generate_brex_transactions(0, sizes['brex_transactions']))
+
+    def load_brex_transactions(df: pd.DataFrame) -> int:
+        conn = StandInSnowflakeConnection([column.upper() for column in df.columns])
+        return loader.load_df_into_table(conn, df, 'DASHBOARD_DATA', 'BREX', 'TRANSACTION_DATA', write=stand_in_write_pandas) # type: ignore
+
+    return {
+        'get_brex_transaction_data': (set_sizes, lambda _: len(loader.get_brex_transaction_data())),
+        'get_profiles_in_time_period': (set_sizes, lambda _: len(loader.get_profiles_in_time_period('first_seen', datetime.datetime(2023, 1, 1), datetime.datetime(2023, 1, 31), loader.DistinctIdCodes())['distinct_id_codes'])),
+        'get_mixpanel_retention_data': (get_users_in_time_periods, lambda users: len(loader.get_mixpanel_retention_data(users))),
+        'get_mixpanel_data_from_export': (get_activity_index_path, lambda path: len(loader.get_mixpanel_data_from_export('weekly', activity_index_path=path)[1])),
+        'get_revenue_and_customers_dataframe': (
+            lambda: (generate_stripe_subscriptions(sizes['stripe_subscriptions']), generate_team_customers(sizes['team_customers'])),
+            lambda data: len(main.get_revenue_and_customers_dataframe(data[0], data[1], 'MRR', 'Daily', all_time=True)),
+        ),
+        'get_retention_dict': (get_retention_table, lambda retention_data: len(main.get_retention_dict(main.get_retention_long_format(retention_data), 12))),
+        'query_notion_database': (set_sizes, lambda _: len(main.query_notion_database(STAND_IN_DATABASE_ID))),
+        'decode_notion_results': (lambda: generate_notion_pages(0, sizes['notion_pages']), lambda results: len(main.decode_notion_results(results, NOTION_SCHEMA))),
+        'categorize_brex_transactions': (lambda: get_brex_transaction_df()['description'], lambda descriptions: len(loader.categorize_brex_transactions(descriptions))),
+        'load_df_into_table': (get_brex_transaction_df, load_brex_transactions),
+    }
+
+def get_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scales', default=','.join(str(scale) for scale in DEFAULT_SCALES), help='Comma separated multiples of our current data size, like 1,10,100,1000')
+    parser.add_argument('--benchmark', action='append', help='Only run this benchmark; can be given more than once. Defaults to every benchmark')
+    parser.add_argument('--repeat', type=int, default=3, help='How many timed runs to take the min and median of')
+    parser.add_argument('--output', default='benchmark_results.json', help='Where to write the results as JSON')
+    args = parser.parse_args()
+
+    server = start_stand_in_server()
+    stand_in_url = f'http://127.0.0.1:{server.server_port}'
+
+    # The loader and dashboard read these when they are imported, so they have to be set first
+    os.environ.update({
+        'BREX_API_URL': f'{stand_in_url}/brex/',
+        'BREX_API_TOKEN': 'stand-in',
+        'BREX_CASH_ACCOUNT_ID': STAND_IN_ACCOUNT_ID,
+        'MIXPANEL_API_URL': f'{stand_in_url}/mixpanel/',
+        'MIXPANEL_EXPORT_API_URL': f'{stand_in_url}/mixpanel-export/',
+        'MIXPANEL_SIGNUP_EVENT': 'finished_signup',
+        'MIXPANEL_PROJECT_ID': 'stand-in',
+        'MIXPANEL_SERVICE_ACCOUNT_USERNAME': 'stand-in',
+        'MIXPANEL_SERVICE_ACCOUNT_PASSWORD': 'stand-in',
+        'MIXPANEL_QUERIES_PER_HOUR': str(10 ** 9),
+        'NOTION_API_URL': f'{stand_in_url}/notion/',
+        'NOTION_API_KEY': 'stand-in',
+    })
+
+    results: List[BenchmarkResult] = []
+    for scale in [int(scale) for scale in args.scales.split(',')]:
+        for name, (setup, run) in get_benchmarks(server, scale).items():
+            if args.benchmark is not None and name not in args.benchmark:
+                continue
+            result = run_benchmark(name, scale, setup, run, args.repeat)
+            results.append(result)
+            print(f"{name} at {scale}x: {result['rows']} rows in {result['seconds_median']:.3f}s (min {result['seconds_min']:.3f}s), peak {result['peak_memory_bytes'] / 1e6:.1f}MB", flush=True)
+
+    server.shutdown()
+
+    with open(args.output, 'w') as f:
+        json.dump({'commit': get_commit(), 'created_at': datetime.datetime.now().isoformat(), 'base_sizes': BASE_SIZES, 'results': results}, f, indent=2)
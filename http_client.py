@@ -0,0 +1,135 @@
+# This file is the HTTP client that the loader and the dashboard use for every API source
+
+
+import email.utils
+import math
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, TypedDict
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import instrumentation
+
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', 5))
+HTTP_BACKOFF_BASE_SECONDS = float(os.environ.get('HTTP_BACKOFF_BASE_SECONDS', 1))
+HTTP_BACKOFF_MAX_SECONDS = float(os.environ.get('HTTP_BACKOFF_MAX_SECONDS', 60))
+HTTP_CONNECT_TIMEOUT_SECONDS = float(os.environ.get('HTTP_CONNECT_TIMEOUT_SECONDS', 10))
+HTTP_READ_TIMEOUT_SECONDS = float(os.environ.get('HTTP_READ_TIMEOUT_SECONDS', 120))
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 10))
+
+# Rate limits and server errors are worth waiting out, anything else is our fault
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+class EndpointStats(TypedDict):
+    requests: int
+    retries: int
+    failures: int
+    seconds: float
+    bytes_received: int
+    bytes_decoded: int
+
+sessions: Dict[str, requests.Session] = {}
+sessions_lock = threading.Lock()
+
+endpoint_stats: Dict[str, EndpointStats] = {}
+endpoint_stats_lock = threading.Lock()
+
+def get_session(host: str) -> requests.Session:
+    # One session per host, so every page after the first reuses an open keep-alive connection
+    with sessions_lock:
+        if host not in sessions:
+            session = requests.Session()
+            session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE))
+            session.headers['Accept-Encoding'] = 'gzip'
+            sessions[host] = session
+        return sessions[host]
+
+def record_attempt(endpoint: str, seconds: float, response: Optional[requests.Response], retried: bool, streamed: bool=False) -> None:
+    if response is None:
+        error: Optional[str] = 'ConnectionError'
+    else:
+        error = None if response.ok else str(response.status_code)
+    # A streamed body hasn't been read yet, and reading it here would load all of it into memory
+    num_bytes = len(response.content) if response is not None and not streamed else None
+    instrumentation.record({
+        'category': 'api_request', 'name': endpoint, 'started_at': time.time() - seconds, 'seconds': seconds,
+        'rows': None, 'bytes': num_bytes, 'cache': None, 'error': error,
+    })
+
+    with endpoint_stats_lock:
+        stats = endpoint_stats.setdefault(endpoint, {'requests': 0, 'retries': 0, 'failures': 0, 'seconds': 0.0, 'bytes_received': 0, 'bytes_decoded': 0})
+        stats['requests'] += 1
+        stats['seconds'] += seconds
+        if retried:
+            stats['retries'] += 1
+        if response is None or not response.ok:
+            stats['failures'] += 1
+        if response is not None and num_bytes is not None:
+            # The raw stream counts what came over the wire, before it was decompressed
+            stats['bytes_decoded'] += num_bytes
+            stats['bytes_received'] += response.raw.tell() if response.raw is not None else num_bytes
+
+def get_endpoint_stats() -> Dict[str, EndpointStats]:
+    with endpoint_stats_lock:
+        return {endpoint: {**stats} for endpoint, stats in endpoint_stats.items()}
+
+def get_retry_after_seconds(response: requests.Response) -> Optional[float]:
+    retry_after = response.headers.get('Retry-After')
+    if retry_after is None:
+        return None
+    try:
+        seconds = float(retry_after)
+    except ValueError:
+        pass
+    else:
+        return max(0.0, seconds) if math.isfinite(seconds) else None
+
+    # Otherwise it is an HTTP date, and anything we can't parse falls back to our own backoff
+    try:
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+def get_backoff_seconds(attempt: int, response: Optional[requests.Response]) -> float:
+    # The server knows how long its limit lasts, like Mixpanel's hourly one, so its wait is never shortened.
+    # The cap is only for the backoff we work out ourselves
+    retry_after = get_retry_after_seconds(response) if response is not None else None
+    if retry_after is not None:
+        return retry_after
+    return min(HTTP_BACKOFF_BASE_SECONDS * 2 ** attempt, HTTP_BACKOFF_MAX_SECONDS)
+
+def request(method: str, url: str, endpoint: Optional[str]=None, max_retries: int=HTTP_MAX_RETRIES, before_attempt: Optional[Callable[[], None]]=None, **kwargs: Any) -> requests.Response:
+    host = urlsplit(url).netloc
+    endpoint = endpoint if endpoint is not None else f'{method} {host}'
+    session = get_session(host)
+    streamed = kwargs.get('stream', False)
+    kwargs.setdefault('timeout', (HTTP_CONNECT_TIMEOUT_SECONDS, HTTP_READ_TIMEOUT_SECONDS))
+
+    for attempt in range(max_retries + 1):
+        # Runs before every attempt, retries included, like waiting on a rate limit that counts each one
+        if before_attempt is not None:
+            before_attempt()
+        start = time.perf_counter()
+        response: Optional[requests.Response] = None
+        try:
+            response = session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            record_attempt(endpoint, time.perf_counter() - start, None, attempt > 0, streamed)
+            if attempt == max_retries:
+                raise
+        else:
+            record_attempt(endpoint, time.perf_counter() - start, response, attempt > 0, streamed)
+            if response.status_code not in RETRY_STATUS_CODES or attempt == max_retries:
+                response.raise_for_status()
+                return response
+            # Hands the connection back to the pool, which a streamed response only does once it is read or closed
+            response.close()
+
+        time.sleep(get_backoff_seconds(attempt, response))
+
+    raise AssertionError('unreachable')
@@ -0,0 +1,138 @@
+# This file records how long the loader and the dashboard spend on each operation, and how much data it moved
+
+
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, Iterator, List, Literal, Optional, TypedDict, TypeVar
+
+import pandas as pd
+
+# Only the most recent measurements are kept, so a long running dashboard doesn't grow without bound
+INSTRUMENTATION_MAX_MEASUREMENTS = int(os.environ.get('INSTRUMENTATION_MAX_MEASUREMENTS', 10_000))
+
+CacheResult = Literal['hit', 'miss']
+
+class Measurement(TypedDict):
+    category: str
+    name: str
+    started_at: float
+    seconds: float
+    rows: Optional[int]
+    bytes: Optional[int]
+    cache: Optional[CacheResult]
+    error: Optional[str]
+
+measurements: Deque[Measurement] = deque(maxlen=INSTRUMENTATION_MAX_MEASUREMENTS)
+measurements_lock = threading.Lock()
+
+# Set by the body of a cached function, which only runs on a cache miss
+cache_misses = threading.local()
+
+F = TypeVar('F', bound=Callable[..., Any])
+
+def note_cache_miss() -> None:
+    cache_misses.missed = True
+
+def record(measurement: Measurement) -> None:
+    with measurements_lock:
+        measurements.append(measurement)
+
+def describe_result(result: Any) -> Dict[str, Optional[int]]:
+    # Shallow memory usage, as counting every string in an object column costs more than the operation itself
+    if isinstance(result, pd.DataFrame):
+        return {'rows': len(result), 'bytes': int(result.memory_usage(index=False).sum())}
+    if isinstance(result, list):
+        return {'rows': len(result), 'bytes': None}
+    return {'rows': None, 'bytes': None}
+
+@contextmanager
+def measure(category: str, name: str, cached: bool=False) -> Iterator[Measurement]:
+    # The caller can fill in rows, bytes or cache on the measurement it is handed
+    measurement: Measurement = {'category': category, 'name': name, 'started_at': time.time(), 'seconds': 0.0, 'rows': None, 'bytes': None, 'cache': None, 'error': None}
+    if cached:
+        cache_misses.missed = False
+
+    start = time.perf_counter()
+    try:
+        yield measurement
+    except Exception as e:
+        measurement['error'] = type(e).__name__
+        raise
+    finally:
+        measurement['seconds'] = time.perf_counter() - start
+        if cached:
+            measurement['cache'] = 'miss' if getattr(cache_misses, 'missed', False) else 'hit'
+        record(measurement)
+
+def timed(category: str, name: Optional[str]=None, cached: bool=False) -> Callable[[F], F]:
+    def decorator(func: F) -> F:
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with measure(category, name or func.__name__, cached=cached) as measurement:
+                result = func(*args, **kwargs)
+                measurement.update(describe_result(result)) # type: ignore
+            return result
+        return wrapper # type: ignore
+    return decorator
+
+def get_measurements() -> List[Measurement]:
+    with measurements_lock:
+        return list(measurements)
+
+def summarize_measurements(measurements: List[Measurement]) -> pd.DataFrame:
+    columns = ['category', 'name', 'calls', 'cache_hits', 'cache_misses', 'errors', 'total_seconds', 'mean_ms', 'max_ms', 'rows', 'bytes']
+    if len(measurements) == 0:
+        return pd.DataFrame(columns=columns)
+
+    df = pd.DataFrame(measurements)
+    summary = df.groupby(['category', 'name']).agg(
+        calls=('seconds', 'size'),
+        cache_hits=('cache', lambda cache: int((cache == 'hit').sum())),
+        cache_misses=('cache', lambda cache: int((cache == 'miss').sum())),
+        errors=('error', 'count'),
+        total_seconds=('seconds', 'sum'),
+        mean_ms=('seconds', lambda seconds: seconds.mean() * 1000),
+        max_ms=('seconds', lambda seconds: seconds.max() * 1000),
+        rows=('rows', 'sum'),
+        bytes=('bytes', 'sum'),
+    ).reset_index()
+    return summary.sort_values(by='total_seconds', ascending=False)[columns].reset_index(drop=True)
+
+def write_measurements_jsonl(path: str, measurements: List[Measurement]) -> None:
+    with open(path, 'a') as f:
+        for measurement in measurements:
+            f.write(json.dumps(measurement) + '\n')
+
+def escape_prometheus_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def write_prometheus_text(path: str, measurements: List[Measurement], prefix: str='dashboard') -> None:
+    # In the text exposition format, so the file can be picked up by node_exporter's textfile collector
+    summary = summarize_measurements(measurements)
+    metrics = [
+        ('operation_seconds_total', 'counter', 'Total seconds spent on the operation', 'total_seconds'),
+        ('operation_calls_total', 'counter', 'Number of times the operation ran', 'calls'),
+        ('operation_errors_total', 'counter', 'Number of times the operation raised', 'errors'),
+        ('operation_rows_total', 'counter', 'Rows the operation read or wrote', 'rows'),
+        ('operation_bytes_total', 'counter', 'Bytes the operation read or wrote', 'bytes'),
+        ('operation_cache_hits_total', 'counter', 'Number of times the operation was served from cache', 'cache_hits'),
+        ('operation_cache_misses_total', 'counter', 'Number of times the operation missed the cache', 'cache_misses'),
+    ]
+
+    lines = []
+    for metric, metric_type, help_text, column in metrics:
+        lines.append(f'# HELP {prefix}_{metric} {help_text}')
+        lines.append(f'# TYPE {prefix}_{metric} {metric_type}')
+        for row in summary.itertuples(index=False):
+            labels = f'category="{escape_prometheus_label(row.category)}",name="{escape_prometheus_label(row.name)}"'
+            lines.append(f'{prefix}_{metric}{{{labels}}} {getattr(row, column)}')
+
+    # Written to the side and renamed, so a scrape never sees half a file
+    with open(path + '.tmp', 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(path + '.tmp', path)
@@ -1,18 +1,33 @@
 # This file loads things and puts them in snowflake
 
 
+import argparse
 import datetime
+import functools
+import gzip
+import itertools
 import json
 import logging
 import os
-from typing import Any, Dict, List, Optional, Tuple, TypedDict
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Literal, Optional, Set, Tuple, TypedDict
 
 from datetime import timedelta
-from dateutil import rrule
-import csv
+from dateutil import rrule, tz
+from dateutil.relativedelta import relativedelta
+import numpy as np
 import pandas as pd
-import requests
 import snowflake.connector
+from snowflake.connector.pandas_tools import write_pandas
+
+import http_client
+import instrumentation
+
 logging.getLogger('snowflake.connector').setLevel(logging.WARNING)
 logging.getLogger('stripe').setLevel(logging.WARNING)
 
@@ -28,12 +43,16 @@ def get_value_for_sql_string(val: Any) -> str:
         return f'"{val}"'
     return str(val)
 
-def write_df_to_snowflake(df: pd.DataFrame, warehouse: str, database: str, schema: str, table: str, clear_table=False):
+# Frames are staged as compressed Parquet files of at most this many rows each
+SNOWFLAKE_WRITE_CHUNK_SIZE = int(os.environ.get('SNOWFLAKE_WRITE_CHUNK_SIZE', 500_000))
 
-    print(df.columns)
+class WriteResult(TypedDict):
+    table: str
+    rows: int
+    seconds: float
 
-    # Gets the version
-    conn = snowflake.connector.connect(
+def get_snowflake_connection(warehouse: str, database: str, schema: Optional[str]=None) -> snowflake.connector.SnowflakeConnection:
+    return snowflake.connector.connect(
         user=get_secret('SNOWFLAKE_USERNAME'),
         password=get_secret('SNOWFLAKE_PASSWORD'),
         account=get_secret('SNOWFLAKE_ACCOUNT'),
@@ -42,115 +61,522 @@ def write_df_to_snowflake(df: pd.DataFrame, warehouse: str, database: str, schem
         schema=schema
     )
 
-    df.to_csv('to_write.csv', index=False, header=False, quoting=csv.QUOTE_NONNUMERIC)
-
-    conn.cursor().execute(f"PUT file://to_write.csv @~/staged OVERWRITE=TRUE")
-    if clear_table:
-        conn.cursor().execute(f'DELETE FROM {table}')
-    conn.cursor().execute(f"COPY INTO {table} FROM @~/staged/to_write.csv FILE_FORMAT=(FORMAT_NAME=CSVWITHOPTIONALQUOTE)")
-
-    os.remove('to_write.csv')
-
-def do_brex_api_call(path, next_cursor=None) -> Tuple[List, Optional[str]]:
-    url = "https://platform.brexapis.com/v2/" + path + ('' if next_cursor is None else f'?cursor={next_cursor}')
+def get_table_columns(conn: snowflake.connector.SnowflakeConnection, database: str, schema: str, table: str) -> List[str]:
+    cur = conn.cursor()
+    cur.execute(f'SELECT * FROM {database}.{schema}.{table} LIMIT 0')
+    return [column[0] for column in cur.description]
+
+def load_df_into_table(conn: snowflake.connector.SnowflakeConnection, df: pd.DataFrame, database: str, schema: str, table: str, by_name: bool=True, write: Callable[..., Tuple[bool, int, int, Any]]=write_pandas) -> int:
+    columns = get_table_columns(conn, database, schema, table)
+    if by_name:
+        # Brex leaves out keys it has no value for, so an incremental batch can be missing columns the table has.
+        # Each column goes in the table column of the same name, whatever its case, and the missing ones are left null
+        df_columns = {str(column).lower(): column for column in df.columns}
+        if not any(column.lower() in df_columns for column in columns):
+            raise ValueError(f'None of the columns {list(df.columns)} are in {database}.{schema}.{table}')
+        df = pd.DataFrame({
+            column: df[df_columns[column.lower()]] if column.lower() in df_columns else pd.Series(None, index=df.index, dtype=object)
+            for column in columns
+        }, index=df.index)
+    else:
+        # Frames whose columns are display names go in by position, and any extra columns are dropped
+        df = df.iloc[:, :len(columns)].set_axis(columns[:len(df.columns)], axis=1)
+
+    # write_pandas stages under a unique temporary stage, so loads can run side by side. The benchmark passes
+    # its own write, so it never depends on how write_pandas talks to the connection
+    _, _, num_rows, _ = write(
+        conn, df, table, database=database, schema=schema, 
+        chunk_size=SNOWFLAKE_WRITE_CHUNK_SIZE, compression='snappy', use_logical_type=True
+    )
+    return num_rows
+
+def write_df_to_snowflake(df: pd.DataFrame, warehouse: str, database: str, schema: str, table: str, clear_table=False, conn: Optional[snowflake.connector.SnowflakeConnection]=None, by_name: bool=True) -> WriteResult:
+
+    start = time.perf_counter()
+
+    with instrumentation.measure('snowflake_write', f'{schema}.{table}') as measurement:
+        owns_conn = conn is None
+        if conn is None:
+            conn = get_snowflake_connection(warehouse, database)
+
+        try:
+            if clear_table:
+                # Load a fresh copy of the table off to the side and swap it in, so 
+                # readers see either the old rows or the new ones, never an empty table
+                target_table = f'{database}.{schema}.{table}'
+                shadow_table = f'{database}.{schema}.{table}_SHADOW'
+                conn.cursor().execute(f'CREATE OR REPLACE TABLE {shadow_table} LIKE {target_table} COPY GRANTS')
+                num_rows = load_df_into_table(conn, df, database, schema, f'{table}_SHADOW', by_name=by_name)
+                conn.cursor().execute(f'ALTER TABLE {target_table} SWAP WITH {shadow_table}')
+                conn.cursor().execute(f'DROP TABLE {shadow_table}')
+            else:
+                num_rows = load_df_into_table(conn, df, database, schema, table, by_name=by_name)
+        finally:
+            if owns_conn:
+                conn.close()
+        measurement.update(instrumentation.describe_result(df)) # type: ignore
+        measurement['rows'] = num_rows
+
+    return {'table': f'{schema}.{table}', 'rows': num_rows, 'seconds': time.perf_counter() - start}
+
+def merge_df_into_snowflake(df: pd.DataFrame, warehouse: str, database: str, schema: str, table: str, key_column: str='id', conn: Optional[snowflake.connector.SnowflakeConnection]=None) -> WriteResult:
+
+    start = time.perf_counter()
+
+    with instrumentation.measure('snowflake_write', f'{schema}.{table}') as measurement:
+        owns_conn = conn is None
+        if conn is None:
+            conn = get_snowflake_connection(warehouse, database)
+
+        try:
+            # Load into a session-scoped staging table shaped like the target, then upsert from it by key,
+            # so readers never see the target table empty or half-written
+            target_table = f'{database}.{schema}.{table}'
+            staging_table = f'{database}.{schema}.{table}_STAGING'
+            conn.cursor().execute(f'CREATE OR REPLACE TEMPORARY TABLE {staging_table} LIKE {target_table}')
+            num_rows = load_df_into_table(conn, df, database, schema, f'{table}_STAGING')
+
+            columns = get_table_columns(conn, database, schema, f'{table}_STAGING')
+            key = next(column for column in columns if column.lower() == key_column.lower())
+
+            update_columns = ', '.join(f'target.{column} = staging.{column}' for column in columns if column != key)
+            insert_columns = ', '.join(columns)
+            insert_values = ', '.join(f'staging.{column}' for column in columns)
+            conn.cursor().execute(f"""
+                MERGE INTO {target_table} AS target USING {staging_table} AS staging ON target.{key} = staging.{key}
+                WHEN MATCHED THEN UPDATE SET {update_columns}
+                WHEN NOT MATCHED THEN INSERT ({insert_columns}) VALUES ({insert_values})
+            """)
+        finally:
+            if owns_conn:
+                conn.close()
+        measurement.update(instrumentation.describe_result(df)) # type: ignore
+        measurement['rows'] = num_rows
+
+    return {'table': f'{schema}.{table}', 'rows': num_rows, 'seconds': time.perf_counter() - start}
+
+def get_max_value_in_snowflake_table(warehouse: str, database: str, schema: str, table: str, column: str, conn: Optional[snowflake.connector.SnowflakeConnection]=None) -> Optional[Any]:
+    owns_conn = conn is None
+    if conn is None:
+        conn = get_snowflake_connection(warehouse, database)
+
+    try:
+        with instrumentation.measure('snowflake_read', f'{schema}.{table}'):
+            cur = conn.cursor()
+            cur.execute(f'SELECT MAX({column}) FROM {database}.{schema}.{table}')
+            return cur.fetchone()[0]
+    finally:
+        if owns_conn:
+            conn.close()
+
+# The API base URLs can be pointed somewhere else, like the stand-in server in benchmark.py
+BREX_API_URL = os.environ.get('BREX_API_URL', 'https://platform.brexapis.com/v2/')
+MIXPANEL_API_URL = os.environ.get('MIXPANEL_API_URL', 'https://mixpanel.com/api/2.0/')
+MIXPANEL_EXPORT_API_URL = os.environ.get('MIXPANEL_EXPORT_API_URL', 'https://data.mixpanel.com/api/2.0/')
+
+def do_brex_api_call(path, next_cursor=None, params: Optional[Dict[str, str]]=None) -> Tuple[List, Optional[str]]:
+    url = BREX_API_URL + path
+
+    params = dict(params or {})
+    if next_cursor is not None:
+        params['cursor'] = next_cursor
 
     headers = {"Authorization": f"Bearer {get_secret('BREX_API_TOKEN')}"}
 
-    response = requests.get(url, headers=headers)
+    # Account ids are templated out, so every account shares one row of request stats
+    endpoint = 'brex ' + path.replace(get_secret('BREX_CASH_ACCOUNT_ID'), '{account_id}')
+    response = http_client.request('GET', url, endpoint=endpoint, headers=headers, params=params)
 
     data = response.json()
     return data['items'], data['next_cursor'] if 'next_cursor' in data else None
 
-def get_brex_transaction_data():
-
-    path = 'transactions/cash/' + get_secret('BREX_CASH_ACCOUNT_ID')
-    data, cursor = do_brex_api_call(path)
+def iter_brex_pages(path: str, params: Optional[Dict[str, str]]=None) -> Iterator[List]:
+    data, cursor = do_brex_api_call(path, params=params)
+    yield data
     while cursor is not None:
-        new_data, cursor = do_brex_api_call(path, cursor)
-        data.extend(new_data)
+        data, cursor = do_brex_api_call(path, cursor, params=params)
+        yield data
+
+def get_brex_money_columns(money: pd.Series) -> Tuple[pd.Series, pd.Series]:
+    # Splits a column of {'amount': cents, 'currency': ...} dicts into a dollar amount column and a currency column
+    money_df = pd.DataFrame(money.tolist(), index=money.index)
+    return money_df['amount'].astype('float64') / 100, money_df['currency']
+
+def get_brex_page_columns(page: List[Dict[str, Any]], df: pd.DataFrame, added_columns: List[str]) -> List[str]:
+    # The added columns used to be set on each dict, so they came right after the first item's keys and
+    # before any key that only shows up in a later item. The columns are kept in that order
+    leading_columns = list(dict.fromkeys([*page[0], *added_columns]))
+    return leading_columns + [column for column in df.columns if column not in leading_columns]
+
+@instrumentation.timed('transform')
+def normalize_brex_transaction_page(page: List[Dict[str, Any]]) -> pd.DataFrame:
+    df = pd.DataFrame(page)
+    amount, currency = get_brex_money_columns(df['amount'])
+    df['currency'] = currency
+    df['amount'] = amount
+    df['month'] = pd.to_datetime(df['posted_at_date']).dt.to_period('M').dt.to_timestamp()
+    return df[get_brex_page_columns(page, df, ['currency', 'month'])]
+
+# Transactions are put in categories by the rules in this file, which are tried in order. A rule matches
+# a description that "equals", "contains", starts with ("prefix") or matches a "regex", and can set the 
+# "source" a transaction is grouped by, which is otherwise the description up to the first dash
+TRANSACTION_CATEGORY_RULES_PATH = os.environ.get('TRANSACTION_CATEGORY_RULES_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'transaction_categories.json'))
+
+class TransactionCategoryRule(TypedDict, total=False):
+    category: str
+    source: str
+    equals: str
+    contains: str
+    prefix: str
+    regex: str
+
+class TransactionCategoryMatcher(TypedDict):
+    patterns: List[re.Pattern]
+    categories: List[str]
+    sources: List[Optional[str]]
+    default_category: str
+
+def get_transaction_category_rule_pattern(rule: TransactionCategoryRule) -> str:
+    # Every pattern is searched for, so a regex is used just as it was written
+    if 'equals' in rule:
+        return r'\A' + re.escape(rule['equals']) + r'\Z'
+    if 'contains' in rule:
+        return re.escape(rule['contains'])
+    if 'prefix' in rule:
+        return r'\A' + re.escape(rule['prefix'])
+    if 'regex' in rule:
+        return rule['regex']
+    raise ValueError(f'Transaction category rule {rule} needs one of equals, contains, prefix or regex')
+
+def compile_transaction_category_rule(rule: TransactionCategoryRule) -> re.Pattern:
+    try:
+        return re.compile(get_transaction_category_rule_pattern(rule), re.DOTALL)
+    except re.error as e:
+        raise ValueError(f'Transaction category rule {rule} has a regex that does not compile: {e}') from e
+
+@functools.lru_cache(maxsize=None)
+def get_transaction_category_matcher(path: str=TRANSACTION_CATEGORY_RULES_PATH) -> TransactionCategoryMatcher:
+    with open(path) as f:
+        config = json.load(f)
+
+    rules: List[TransactionCategoryRule] = config['rules']
+    # Each rule is compiled on its own, so a bad one is reported by name and a regex can use backreferences and inline flags
+    return {
+        'patterns': [compile_transaction_category_rule(rule) for rule in rules],
+        'categories': [rule['category'] for rule in rules],
+        'sources': [rule.get('source') for rule in rules],
+        'default_category': config['default_category'],
+    }
 
-    # We go through and parse our amount and currency
-    for d in data:
-        d['currency'] = d['amount']['currency']
-        d['amount'] = float(d['amount']['amount']) / 100
-        d['month'] = pd.to_datetime(d['posted_at_date']).replace(day=1)
+@instrumentation.timed('transform')
+def categorize_brex_transactions(descriptions: pd.Series, rules_path: str=TRANSACTION_CATEGORY_RULES_PATH) -> pd.DataFrame:
+    matcher = get_transaction_category_matcher(rules_path)
+
+    # The same few descriptions repeat across thousands of transactions, so each is only matched once
+    codes, unique_descriptions = pd.factorize(descriptions.fillna(''))
+    unique_descriptions = pd.Series(unique_descriptions, dtype=object)
+
+    # Descriptions that no rule matches get the default category, which goes after the rules. Each rule
+    # is only tried on the descriptions no earlier rule matched, so the first rule that matches wins
+    num_rules = len(matcher['categories'])
+    rule_indexes = np.full(len(unique_descriptions), num_rules)
+    for i, pattern in enumerate(matcher['patterns']):
+        unmatched = np.flatnonzero(rule_indexes == num_rules)
+        if len(unmatched) == 0:
+            break
+        matched = np.array([pattern.search(description) is not None for description in unique_descriptions.iloc[unmatched]], dtype=bool)
+        rule_indexes[unmatched[matched]] = i
+
+    categories = np.array(matcher['categories'] + [matcher['default_category']], dtype=object)
+    sources = np.array(matcher['sources'] + [None], dtype=object)
+
+    unique_sources = sources[rule_indexes]
+    split_sources = unique_descriptions.str.split('-', n=1).str[0].to_numpy(dtype=object)
+    unique_sources = np.where(pd.isna(unique_sources), split_sources, unique_sources)
+
+    return pd.DataFrame({'category': categories[rule_indexes][codes], 'source': unique_sources[codes]}, index=descriptions.index)
+
+@instrumentation.timed('transform')
+def normalize_brex_statement_page(page: List[Dict[str, Any]]) -> pd.DataFrame:
+    df = pd.DataFrame(page)
+    period = pd.DataFrame(df['period'].tolist(), index=df.index)
+    df['start_date'] = period['start_date']
+    df['end_date'] = period['end_date']
+    df['start_balance'], _ = get_brex_money_columns(df['start_balance'])
+    df['end_balance'], _ = get_brex_money_columns(df['end_balance'])
+    df['burn'] = (df['start_balance'] - df['end_balance']).round().astype('int64')
+    return df[get_brex_page_columns(page, df, ['start_date', 'end_date', 'burn'])].drop(['period'], axis=1)
+
+@instrumentation.timed('extract')
+def get_brex_transaction_data(posted_at_start: Optional[datetime.date]=None):
+
+    # With a watermark, only transactions posted on or after it are fetched
+    params = {} if posted_at_start is None else {'posted_at_start': posted_at_start.strftime('%Y-%m-%dT00:00:00Z')}
+
+    # We normalize each page as it arrives, so we only ever hold one page of raw dicts
+    path = 'transactions/cash/' + get_secret('BREX_CASH_ACCOUNT_ID')
+    pages = [normalize_brex_transaction_page(page) for page in iter_brex_pages(path, params) if len(page) > 0]
+    if len(pages) == 0:
+        # No new transactions since the watermark is normal, but a full extract with none would empty the table
+        if posted_at_start is None:
+            raise ValueError('Brex returned no transactions for the cash account')
+        return pd.DataFrame()
 
-    df = pd.DataFrame(data)    
+    df = pd.concat(pages, ignore_index=True)
+    # Categorized over the whole column at once, after the pages are put together
+    df[['category', 'source']] = categorize_brex_transactions(df['description'])
 
     # Then, write it to snowflake
     
     return df
 
-
+def categorize_stored_brex_transactions(conn: snowflake.connector.SnowflakeConnection) -> WriteResult:
+    # Transactions loaded before they were categorized are filled in once, from their distinct descriptions
+    start = time.perf_counter()
+    with instrumentation.measure('snowflake_write', 'BREX.TRANSACTION_DATA') as measurement:
+        conn.cursor().execute('ALTER TABLE DASHBOARD_DATA.BREX.TRANSACTION_DATA ADD COLUMN IF NOT EXISTS category VARCHAR, source VARCHAR')
+
+        cur = conn.cursor()
+        cur.execute('SELECT DISTINCT description FROM DASHBOARD_DATA.BREX.TRANSACTION_DATA WHERE category IS NULL')
+        descriptions = pd.Series([description for description, in cur.fetchall()], dtype=object)
+        if len(descriptions) == 0:
+            measurement['rows'] = 0
+            return {'table': 'BREX.TRANSACTION_DATA', 'rows': 0, 'seconds': time.perf_counter() - start}
+
+        categories = pd.concat([descriptions.rename('description'), categorize_brex_transactions(descriptions)], axis=1)
+        conn.cursor().execute('CREATE OR REPLACE TEMPORARY TABLE DASHBOARD_DATA.BREX.TRANSACTION_CATEGORIES_STAGING (description VARCHAR, category VARCHAR, source VARCHAR)')
+        load_df_into_table(conn, categories, 'DASHBOARD_DATA', 'BREX', 'TRANSACTION_CATEGORIES_STAGING')
+
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE DASHBOARD_DATA.BREX.TRANSACTION_DATA AS target SET category = staging.category, source = staging.source
+            FROM DASHBOARD_DATA.BREX.TRANSACTION_CATEGORIES_STAGING AS staging
+            WHERE target.category IS NULL AND EQUAL_NULL(target.description, staging.description)
+        """)
+        measurement['rows'] = cur.rowcount
+
+    return {'table': 'BREX.TRANSACTION_DATA', 'rows': measurement['rows'], 'seconds': time.perf_counter() - start}
+
+def sync_brex_transaction_data(full_refresh=False, conn: Optional[snowflake.connector.SnowflakeConnection]=None) -> WriteResult:
+    if full_refresh:
+        tx_data = get_brex_transaction_data()
+        return write_df_to_snowflake(tx_data, 'COMPUTE_WH', 'DASHBOARD_DATA', 'BREX', 'TRANSACTION_DATA', clear_table=True, conn=conn)
+
+    # The latest posted date we already have is the watermark. We refetch that whole day, as more
+    # transactions can post on it after we last ran, and the merge drops the ones we already have
+    watermark = get_max_value_in_snowflake_table('COMPUTE_WH', 'DASHBOARD_DATA', 'BREX', 'TRANSACTION_DATA', 'posted_at_date', conn=conn)
+    tx_data = get_brex_transaction_data(None if watermark is None else pd.to_datetime(watermark).date())
+    if len(tx_data) == 0:
+        return {'table': 'BREX.TRANSACTION_DATA', 'rows': 0, 'seconds': 0.0}
+    return merge_df_into_snowflake(tx_data, 'COMPUTE_WH', 'DASHBOARD_DATA', 'BREX', 'TRANSACTION_DATA', key_column='id', conn=conn)
+
+
+# Monthly rollups of BREX.TRANSACTION_DATA, so the dashboard reads one row per month rather than
+# every transaction. Transactions of a million dollars or more are investment, not income or expenses
+MONTHLY_FINANCE_TABLES: Dict[str, str] = {
+    'MONTHLY_INCOME': """
+        SELECT month, SUM(amount) AS amount FROM {transactions}
+        WHERE amount >= 0 AND ABS(amount) < 1000000 AND initiated_at_date >= '2022-10-01'
+        GROUP BY month
+    """,
+    'MONTHLY_INCOME_BY_SOURCE': """
+        SELECT month, source AS short_description, SUM(amount) AS amount FROM {transactions}
+        WHERE amount >= 0 AND ABS(amount) < 1000000 AND initiated_at_date >= '2022-10-01'
+        GROUP BY month, short_description
+    """,
+    'MONTHLY_STRIPE_REVENUE': """
+        SELECT month, SUM(amount) AS amount FROM {transactions}
+        WHERE amount >= 0 AND ABS(amount) < 1000000 AND category = 'stripe_revenue'
+        GROUP BY month
+    """,
+    'MONTHLY_EXPENSES': """
+        SELECT month, SUM(-amount) AS amount FROM {transactions}
+        WHERE amount < 0 AND ABS(amount) < 1000000
+        GROUP BY month
+    """,
+    'MONTHLY_PAYROLL': """
+        SELECT month, SUM(-amount) AS amount FROM {transactions}
+        WHERE amount < 0 AND ABS(amount) < 1000000 AND category = 'payroll'
+        GROUP BY month
+    """,
+}
+
+def materialize_monthly_finance_tables(conn: Optional[snowflake.connector.SnowflakeConnection]=None) -> List[WriteResult]:
+    owns_conn = conn is None
+    if conn is None:
+        conn = get_snowflake_connection('COMPUTE_WH', 'DASHBOARD_DATA')
+
+    # Computed in the warehouse from the whole table, as an incremental sync only has the new transactions locally
+    write_results: List[WriteResult] = []
+    try:
+        for table, query in MONTHLY_FINANCE_TABLES.items():
+            start = time.perf_counter()
+            with instrumentation.measure('snowflake_write', f'BREX.{table}') as measurement:
+                conn.cursor().execute(f'CREATE OR REPLACE TABLE DASHBOARD_DATA.BREX.{table} COPY GRANTS AS ' + query.format(transactions='DASHBOARD_DATA.BREX.TRANSACTION_DATA'))
+
+                cur = conn.cursor()
+                cur.execute(f'SELECT COUNT(*) FROM DASHBOARD_DATA.BREX.{table}')
+                measurement['rows'] = cur.fetchone()[0]
+            write_results.append({'table': f'BREX.{table}', 'rows': measurement['rows'], 'seconds': time.perf_counter() - start})
+    finally:
+        if owns_conn:
+            conn.close()
+
+    return write_results
+
+@instrumentation.timed('extract')
 def get_brex_account_data():
     path = "accounts/cash/" + get_secret('BREX_CASH_ACCOUNT_ID') + "/statements"
-    data, cursor = do_brex_api_call(path)
-    while cursor is not None:
-        new_data, cursor = do_brex_api_call(path, cursor)
-        data.extend(new_data)
-
-    for d in data:
-        d['start_date'] = d['period']['start_date']
-        d['end_date'] = d['period']['end_date']
-        d['start_balance'] = float(d['start_balance']['amount']) / 100
-        d['end_balance'] = float(d['end_balance']['amount']) / 100
-        d['burn'] = round(d['start_balance'] - d['end_balance'])
+    pages = [normalize_brex_statement_page(page) for page in iter_brex_pages(path) if len(page) > 0]
+    if len(pages) == 0:
+        # Swapping in an empty table would leave the dashboard without a balance
+        raise ValueError('Brex returned no statements for the cash account')
 
-    df = pd.DataFrame(data)
-    df = df.drop(['period'], axis=1)
+    df = pd.concat(pages, ignore_index=True)
 
     # Then, write to snowflake
 
     return df
 
-def get_stripe_subscriptions():
+# Stripe only keeps events for 30 days, so a state older than this has to be rebuilt with a full listing
+STRIPE_STATE_PATH = os.environ.get('STRIPE_STATE_PATH', 'stripe_subscriptions.sqlite')
+STRIPE_EVENT_RETENTION = timedelta(days=30)
+STRIPE_SUBSCRIPTION_EVENT_TYPES = ['customer.subscription.created', 'customer.subscription.updated', 'customer.subscription.deleted']
+
+def open_stripe_state(path: str) -> sqlite3.Connection:
+    con = sqlite3.connect(path)
+    con.execute('CREATE TABLE IF NOT EXISTS subscriptions (id TEXT PRIMARY KEY, start_date INTEGER, ended_at INTEGER, amount INTEGER)')
+    con.execute('CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value INTEGER)')
+    return con
+
+def get_raw_subscription_row(subscription: Any) -> Tuple[str, int, Optional[int], int]:
+    return subscription['id'], subscription['start_date'], subscription['ended_at'], subscription['plan']['amount']
+
+def list_changed_stripe_subscriptions(since: int) -> Iterator[Any]:
+    import stripe
+
+    # Events come newest first, so the first time we see a subscription is its latest state
+    seen_ids = set()
+    for event in stripe.Event.list(types=STRIPE_SUBSCRIPTION_EVENT_TYPES, created={'gte': since}, limit=100).auto_paging_iter():
+        subscription = event['data']['object']
+        if subscription['id'] not in seen_ids:
+            seen_ids.add(subscription['id'])
+            yield subscription
+
+def convert_stripe_timestamps(timestamps: pd.Series) -> pd.Series:
+    # Matches datetime.fromtimestamp, which gives naive datetimes in the local timezone
+    return pd.to_datetime(timestamps, unit='s', utc=True).dt.tz_convert(tz.tzlocal()).dt.tz_localize(None)
+
+@instrumentation.timed('extract')
+def get_stripe_subscriptions(state_path: Optional[str]=STRIPE_STATE_PATH) -> pd.DataFrame:
     import stripe
     stripe.api_key = get_secret('STRIPE_KEY')
 
-    # We list all subscripts all time
-    subscriptions = []
-    current = stripe.Subscription.list(status='all')['data']
-    while len(current) > 0:
-        subscriptions.extend(current)
-        current = stripe.Subscription.list(status='all', limit=100, starting_after=subscriptions[-1]['id'])['data']
+    state = open_stripe_state(state_path if state_path is not None else ':memory:')
+    last_synced_at = state.execute("SELECT value FROM sync_state WHERE key = 'last_synced_at'").fetchone()
+    synced_at = int(time.time())
 
-    start_date = []
-    end_date = []
-    price = []
+    if last_synced_at is not None and synced_at - last_synced_at[0] < STRIPE_EVENT_RETENTION.total_seconds():
+        # Only subscriptions created or changed since the last run
+        subscriptions = list_changed_stripe_subscriptions(last_synced_at[0])
+    else:
+        # We list all subscripts all time
+        subscriptions = stripe.Subscription.list(status='all', limit=100).auto_paging_iter()
+
+    with state:
+        state.executemany('INSERT OR REPLACE INTO subscriptions VALUES (?, ?, ?, ?)', (get_raw_subscription_row(subscription) for subscription in subscriptions))
+        state.execute("INSERT OR REPLACE INTO sync_state VALUES ('last_synced_at', ?)", (synced_at,))
+
+    raw_subscriptions = pd.read_sql('SELECT start_date, ended_at, amount FROM subscriptions ORDER BY rowid', state)
+    state.close()
+
+    # We add the max date onto the end date, as it makes ignoring nulls easier
     default_end_date = datetime.datetime.now() + datetime.timedelta(weeks=(52 * 100)) # 100 years from now
-    for subscription in subscriptions:
-        start_date.append(datetime.datetime.fromtimestamp(subscription['start_date']))
-        # We add the max date onto the end date, as it makes ignoring nulls easier
-        end_date.append(datetime.datetime.fromtimestamp(subscription['ended_at']) if subscription['ended_at'] is not None else default_end_date)
-        price.append(subscription['plan']['amount'] / 100)
+    start_date = convert_stripe_timestamps(raw_subscriptions['start_date'])
+    end_date = convert_stripe_timestamps(raw_subscriptions['ended_at']).fillna(default_end_date)
 
-    df = pd.DataFrame({'start_date': start_date, 'end_date': end_date, 'amount': price})
+    df = pd.DataFrame({'start_date': start_date, 'end_date': end_date, 'amount': raw_subscriptions['amount'] / 100})
     return df
 
 DistinctID = str
 
-class Profile(TypedDict):
-    distinct_id: str
-    email: Optional[str] 
+class DistinctIdCodes:
+    # Each distinct_id is kept once and every cohort refers to it by a small integer, so a user
+    # seen in many months costs four bytes per cohort instead of a string and a dict
+    def __init__(self) -> None:
+        self.codes: Dict[DistinctID, int] = {}
+        self.distinct_ids: List[DistinctID] = []
+        self.lock = threading.Lock()
+
+    def intern(self, distinct_ids: List[DistinctID]) -> np.ndarray:
+        with self.lock:
+            for distinct_id in distinct_ids:
+                if distinct_id not in self.codes:
+                    self.codes[distinct_id] = len(self.distinct_ids)
+                    self.distinct_ids.append(distinct_id)
+            return np.fromiter((self.codes[distinct_id] for distinct_id in distinct_ids), dtype=np.int32, count=len(distinct_ids))
+
+class ProfileColumns(TypedDict):
+    # One code per profile, in the order Mixpanel returned them
+    distinct_id_codes: np.ndarray
+    # Keyed by row, as only the profiles that finished signing up have an email
+    emails: Dict[int, str]
 
 class UsersInTimePeriod(TypedDict):
     start_date: datetime.datetime
     end_date: datetime.datetime
-    started_signup: List[Profile]
-    finished_signup: List[Profile]
-    did_any_event: List[Profile]
+    started_signup: ProfileColumns
+    # Which rows of started_signup have an email
+    finished_signup: np.ndarray
+    did_any_event: ProfileColumns
+
+MixpanelQueryType = Literal['first_seen', 'any_event']
+MIXPANEL_QUERY_TYPES: List[MixpanelQueryType] = ['first_seen', 'any_event']
+
+# Mixpanel allows 60 queries an hour and 5 concurrent queries on the query API
+MIXPANEL_MAX_CONCURRENT_QUERIES = int(os.environ.get('MIXPANEL_MAX_CONCURRENT_QUERIES', 5))
+MIXPANEL_QUERIES_PER_HOUR = int(os.environ.get('MIXPANEL_QUERIES_PER_HOUR', 60))
+
+class SlidingWindowRateLimiter:
+    # Allows at most max_requests in any window_seconds, which a token bucket that starts full doesn't 
+    # guarantee: its first burst and the tokens refilled in the same hour add up to more than the limit
+    def __init__(self, max_requests: int, window_seconds: float):
+        self.max_requests = max_requests
+        self.window_seconds = window_seconds
+        self.request_times: Deque[float] = deque()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                while len(self.request_times) > 0 and self.request_times[0] <= now - self.window_seconds:
+                    self.request_times.popleft()
+                if len(self.request_times) < self.max_requests:
+                    self.request_times.append(now)
+                    return
+                wait = self.request_times[0] + self.window_seconds - now
+
+            time.sleep(wait)
+
+mixpanel_rate_limiter = SlidingWindowRateLimiter(MIXPANEL_QUERIES_PER_HOUR, 3600)
+mixpanel_concurrent_queries = threading.BoundedSemaphore(MIXPANEL_MAX_CONCURRENT_QUERIES)
 
 def get_mixpanel_query(payload: str, headers: Dict[str, str]) -> Dict[str, Any]:
     service_account_username = get_secret('MIXPANEL_SERVICE_ACCOUNT_USERNAME')
     service_account_password = get_secret('MIXPANEL_SERVICE_ACCOUNT_PASSWORD')
 
-    url = "https://mixpanel.com/api/2.0/engage?project_id=" + get_secret('MIXPANEL_PROJECT_ID')
+    url = MIXPANEL_API_URL + "engage?project_id=" + get_secret('MIXPANEL_PROJECT_ID')
 
-    response = requests.post(url, data=payload, headers=headers, auth=(service_account_username, service_account_password))
-    response = json.loads(response.text)
-    return response
+    # Every page and every retry counts against the limits, so we wait on the rate limiter before each attempt
+    with mixpanel_concurrent_queries:
+        response = http_client.request(
+            'POST', url, endpoint='mixpanel engage', before_attempt=mixpanel_rate_limiter.acquire, 
+            data=payload, headers=headers, auth=(service_account_username, service_account_password)
+        )
+    return response.json()
 
-def get_all_profiles_for_payload(payload: str) -> List[Profile]:
+def get_profile_pages_for_payload(payload: str) -> Iterator[List[Dict[str, Any]]]:
 
     # Get those users first seen during a time period
     headers = {
@@ -163,16 +589,34 @@ def get_all_profiles_for_payload(payload: str) -> List[Profile]:
     page = response['page']
     session_id = response['session_id']
 
-    raw_profiles = response['results']
+    num_profiles = len(response['results'])
+    yield response['results']
 
-    while len(raw_profiles) < total_count:
+    while num_profiles < total_count:
         page = page + 1
         new_payload = payload + f'&session_id={session_id}' + f'&page={page}'
         response = get_mixpanel_query(new_payload, headers)
 
-        raw_profiles += response['results']
+        num_profiles += len(response['results'])
+        yield response['results']
+
+def intern_profile_pages(pages: Iterable[List[Dict[str, Any]]], distinct_id_codes: DistinctIdCodes) -> ProfileColumns:
+    # Each page is reduced to codes and emails as it arrives, so the raw results are never all held at once
+    code_pages: List[np.ndarray] = []
+    emails: Dict[int, str] = {}
+    num_profiles = 0
+    for raw_profiles in pages:
+        code_pages.append(distinct_id_codes.intern([profile.get('$distinct_id') for profile in raw_profiles]))
+        for row, profile in enumerate(raw_profiles, start=num_profiles):
+            email = profile['$properties'].get('$email', None)
+            if email is not None:
+                emails[row] = email
+        num_profiles += len(raw_profiles)
 
-    return [{'distinct_id': profile.get('$distinct_id'), 'email': profile['$properties'].get('$email', None)} for profile in raw_profiles]
+    return {'distinct_id_codes': np.concatenate(code_pages) if len(code_pages) > 0 else np.empty(0, dtype=np.int32), 'emails': emails}
+
+def get_all_profiles_for_payload(payload: str, distinct_id_codes: DistinctIdCodes) -> ProfileColumns:
+    return intern_profile_pages(get_profile_pages_for_payload(payload), distinct_id_codes)
 
 
 def get_mixpanel_paylod_for_first_seen(start_date_str='2022-11-01', end_date_str='2022-11-30') -> str:
@@ -183,17 +627,20 @@ def get_mixpanel_payload_for_any_event_during_time_period(start_date_str, end_da
     payload = f'filter_by_cohort=%7B%22raw_cohort%22%3A%7B%22name%22%3A%22%22%2C%22id%22%3Anull%2C%22unsavedId%22%3Anull%2C%22groups%22%3A%5B%7B%22type%22%3A%22cohort_group%22%2C%22event%22%3A%7B%22resourceType%22%3A%22cohort%22%2C%22value%22%3A%22%24all_users%22%2C%22label%22%3A%22All%20Users%22%7D%2C%22filters%22%3A%5B%7B%22customProperty%22%3A%7B%22name%22%3A%22%22%2C%22description%22%3A%22%22%2C%22behavior%22%3A%7B%22filters%22%3A%5B%5D%2C%22aggregationOperator%22%3A%22total%22%2C%22aggregationOperatorPerUser%22%3Anull%2C%22event%22%3A%7B%22value%22%3A%22%24mp_anything_event%22%2C%22label%22%3A%22Any%20event%22%2C%22isRecentlyUsed%22%3Afalse%7D%2C%22filtersOperator%22%3A%22and%22%2C%22behavioralFiltersOperator%22%3A%22and%22%2C%22property%22%3Anull%2C%22dateRange%22%3A%7B%22type%22%3A%22between%22%2C%22from%22%3A%22{start_date_str}%22%2C%22to%22%3A%22{end_date_str}%22%7D%7D%7D%2C%22customPropertyId%22%3Anull%2C%22dataGroupId%22%3Anull%2C%22tempDataGroupId%22%3Anull%2C%22resourceType%22%3A%22user%22%2C%22propertyName%22%3Anull%2C%22propertyObjectKey%22%3Anull%2C%22propertyDefaultType%22%3A%22number%22%2C%22propertyType%22%3A%22number%22%2C%22filterOperator%22%3A%22is%20at%20least%22%2C%22filterValue%22%3A1%7D%5D%2C%22filtersOperator%22%3A%22and%22%2C%22behavioralFiltersOperator%22%3A%22and%22%2C%22groupingOperator%22%3Anull%2C%22property%22%3Anull%7D%5D%7D%7D&'
     return payload
 
-def get_users_in_time_period(start_date: datetime.datetime, end_date: datetime.datetime) -> UsersInTimePeriod:
-
-    # Get those users first seen during a time period
-    any_event_payload = 'output_properties=%5B%22%24email%22%5D&' + get_mixpanel_paylod_for_first_seen(start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d"))
-    first_seen_profiles = get_all_profiles_for_payload(any_event_payload)
+def get_profiles_in_time_period(query_type: MixpanelQueryType, start_date: datetime.datetime, end_date: datetime.datetime, distinct_id_codes: DistinctIdCodes) -> ProfileColumns:
+    start_date_str, end_date_str = start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")
+    if query_type == 'first_seen':
+        # Get those users first seen during a time period
+        payload = get_mixpanel_paylod_for_first_seen(start_date_str, end_date_str)
+    else:
+        # Get those active in a time period
+        payload = get_mixpanel_payload_for_any_event_during_time_period(start_date_str, end_date_str)
 
-    # Get those active in a time period
-    any_event_payload = 'output_properties=%5B%22%24email%22%5D&' + get_mixpanel_payload_for_any_event_during_time_period(start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d"))
-    any_event_profiles = get_all_profiles_for_payload(any_event_payload)
+    return get_all_profiles_for_payload('output_properties=%5B%22%24email%22%5D&' + payload, distinct_id_codes)
 
-    finished_signup = list(filter(lambda profile: profile['email'] is not None, first_seen_profiles))
+def build_users_in_time_period(start_date: datetime.datetime, end_date: datetime.datetime, first_seen_profiles: ProfileColumns, any_event_profiles: ProfileColumns) -> UsersInTimePeriod:
+    finished_signup = np.zeros(len(first_seen_profiles['distinct_id_codes']), dtype=bool)
+    finished_signup[np.fromiter(first_seen_profiles['emails'], dtype=np.intp, count=len(first_seen_profiles['emails']))] = True
 
     return {
         'start_date': start_date,
@@ -203,59 +650,477 @@ def get_users_in_time_period(start_date: datetime.datetime, end_date: datetime.d
         'did_any_event': any_event_profiles
     }
 
+def get_users_in_time_period(start_date: datetime.datetime, end_date: datetime.datetime, distinct_id_codes: DistinctIdCodes) -> UsersInTimePeriod:
+    first_seen_profiles = get_profiles_in_time_period('first_seen', start_date, end_date, distinct_id_codes)
+    any_event_profiles = get_profiles_in_time_period('any_event', start_date, end_date, distinct_id_codes)
+    return build_users_in_time_period(start_date, end_date, first_seen_profiles, any_event_profiles)
 
+
+@instrumentation.timed('transform')
 def get_mixpanel_signup_data(users_in_time_periods: List[UsersInTimePeriod]) -> pd.DataFrame:
     arr = []
     for users_in_time_period in users_in_time_periods:
-        num_signups, num_installs = len(users_in_time_period['finished_signup']), len(users_in_time_period['started_signup'])
+        num_signups, num_installs = int(users_in_time_period['finished_signup'].sum()), len(users_in_time_period['started_signup']['distinct_id_codes'])
         arr.append((users_in_time_period['start_date'], num_signups, num_installs, num_signups / num_installs))
 
     df = pd.DataFrame(arr, columns=['Month', 'Num Signups', 'Num Installs', 'Install Success Rate'])
     return df
 
-def get_mixpanel_retention_data(users_in_time_periods: List[UsersInTimePeriod]) -> pd.DataFrame:
+@instrumentation.timed('transform')
+def get_mixpanel_retention_data(users_in_time_periods: List[UsersInTimePeriod], as_percentage: bool=False) -> pd.DataFrame:
+
+    # Deduplicated once up front, so every pair of cohorts can be intersected as already unique
+    first_seen_cohorts = [np.unique(u['started_signup']['distinct_id_codes']) for u in users_in_time_periods]
+    did_any_event_cohorts = [np.unique(u['did_any_event']['distinct_id_codes']) for u in users_in_time_periods]
 
     retention_rows = []
-    for users_in_time_period in users_in_time_periods:
-        first_seen_in_time_period_ids = [profile['distinct_id'] for profile in users_in_time_period['started_signup']]
-        retention_row = [users_in_time_period['start_date'], users_in_time_period['end_date'], len(first_seen_in_time_period_ids)]
-        for users_in_next_time_period in users_in_time_periods:
+    for users_in_time_period, first_seen_in_time_period_ids in zip(users_in_time_periods, first_seen_cohorts):
+        initial_size = len(users_in_time_period['started_signup']['distinct_id_codes'])
+        retention_row: List[Any] = [users_in_time_period['start_date'], users_in_time_period['end_date'], initial_size]
+        for users_in_next_time_period, did_any_event_ids in zip(users_in_time_periods, did_any_event_cohorts):
             if users_in_time_period['start_date'] > users_in_next_time_period['start_date']:
                 retention_row.append(0)
                 continue
 
-            did_any_event = list(filter(lambda profile: profile['distinct_id'] in first_seen_in_time_period_ids, users_in_next_time_period['did_any_event']))
-            retention_row.append(len(did_any_event))
+            num_retained = len(np.intersect1d(first_seen_in_time_period_ids, did_any_event_ids, assume_unique=True))
+            if as_percentage:
+                retention_row.append(num_retained / initial_size if initial_size > 0 else 0)
+            else:
+                retention_row.append(num_retained)
 
         retention_rows.append(retention_row)
     
     return pd.DataFrame(retention_rows, columns=['Start Date', 'End Date', 'Initial Size'] + [u['start_date'] for u in users_in_time_periods])
 
 
-def get_mixpanel_data() -> Tuple[pd.DataFrame, pd.DataFrame]:
+# Cohorts for closed months never change, so we keep them locally and only refresh recent ones
+MIXPANEL_COHORT_STORE_PATH = os.environ.get('MIXPANEL_COHORT_STORE_PATH', 'mixpanel_cohorts.sqlite')
+MIXPANEL_REFRESH_LOOKBACK_MONTHS = int(os.environ.get('MIXPANEL_REFRESH_LOOKBACK_MONTHS', 1))
+
+def open_mixpanel_cohort_store(path: str) -> sqlite3.Connection:
+    con = sqlite3.connect(path)
+    con.execute('CREATE TABLE IF NOT EXISTS cohorts (query_type TEXT, start_date TEXT, end_date TEXT, fetched_at TEXT, PRIMARY KEY (query_type, start_date, end_date))')
+    con.execute('CREATE TABLE IF NOT EXISTS profiles (query_type TEXT, start_date TEXT, end_date TEXT, distinct_id TEXT, email TEXT)')
+    con.execute('CREATE INDEX IF NOT EXISTS profiles_by_cohort ON profiles (query_type, start_date, end_date)')
+    return con
+
+def load_cohort_from_store(con: sqlite3.Connection, query_type: MixpanelQueryType, start_date: datetime.datetime, end_date: datetime.datetime, distinct_id_codes: DistinctIdCodes) -> Optional[ProfileColumns]:
+    key = (query_type, start_date.isoformat(), end_date.isoformat())
+    # A cohort with no profiles is still stored, so we check the cohorts table to tell it apart from a miss
+    if con.execute('SELECT 1 FROM cohorts WHERE query_type = ? AND start_date = ? AND end_date = ?', key).fetchone() is None:
+        return None
+
+    rows = con.execute('SELECT distinct_id, email FROM profiles WHERE query_type = ? AND start_date = ? AND end_date = ? ORDER BY rowid', key).fetchall()
+    return {
+        'distinct_id_codes': distinct_id_codes.intern([distinct_id for distinct_id, _ in rows]),
+        'emails': {row: email for row, (_, email) in enumerate(rows) if email is not None},
+    }
+
+def save_cohort_to_store(con: sqlite3.Connection, query_type: MixpanelQueryType, start_date: datetime.datetime, end_date: datetime.datetime, profiles: ProfileColumns, distinct_id_codes: DistinctIdCodes) -> None:
+    key = (query_type, start_date.isoformat(), end_date.isoformat())
+    with con:
+        con.execute('DELETE FROM profiles WHERE query_type = ? AND start_date = ? AND end_date = ?', key)
+        con.executemany('INSERT INTO profiles VALUES (?, ?, ?, ?, ?)', (
+            key + (distinct_id_codes.distinct_ids[code], profiles['emails'].get(row))
+            for row, code in enumerate(profiles['distinct_id_codes'].tolist())
+        ))
+        con.execute('INSERT OR REPLACE INTO cohorts VALUES (?, ?, ?, ?)', key + (datetime.datetime.now().isoformat(),))
+
+@instrumentation.timed('extract')
+def get_mixpanel_data(max_workers: int=MIXPANEL_MAX_CONCURRENT_QUERIES, cohort_store_path: Optional[str]=MIXPANEL_COHORT_STORE_PATH) -> Tuple[pd.DataFrame, pd.DataFrame]:
     end_date = datetime.datetime.now()
     end_date = (end_date.replace(day=1) + timedelta(days=32)).replace(day=1)
-    
-    users_in_time_periods = []
-    for start_date, end_date in zip(rrule.rrule(rrule.MONTHLY, dtstart=datetime.datetime(2022, 1, 1), until=end_date), rrule.rrule(rrule.MONTHLY, dtstart=datetime.datetime(2022, 2, 1), until=end_date)):
-        users_in_time_period = get_users_in_time_period(start_date, end_date)
-        users_in_time_periods.append(users_in_time_period)
+    time_periods = list(zip(rrule.rrule(rrule.MONTHLY, dtstart=datetime.datetime(2022, 1, 1), until=end_date), rrule.rrule(rrule.MONTHLY, dtstart=datetime.datetime(2022, 2, 1), until=end_date)))
+
+    # Anything starting on or after this is the open month or in the look-back window, and is always refetched
+    refresh_from = datetime.datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0) - relativedelta(months=MIXPANEL_REFRESH_LOOKBACK_MONTHS)
+
+    cohort_store = open_mixpanel_cohort_store(cohort_store_path) if cohort_store_path is not None else None
+    # Shared by every cohort, so a user's distinct_id is only held once however many months they show up in
+    distinct_id_codes = DistinctIdCodes()
+    cohorts: Dict[Tuple[MixpanelQueryType, datetime.datetime, datetime.datetime], ProfileColumns] = {}
+    if cohort_store is not None:
+        for start_date, end_date in time_periods:
+            if start_date >= refresh_from:
+                continue
+            for query_type in MIXPANEL_QUERY_TYPES:
+                profiles = load_cohort_from_store(cohort_store, query_type, start_date, end_date, distinct_id_codes)
+                if profiles is not None:
+                    cohorts[(query_type, start_date, end_date)] = profiles
+
+    # Fan out every query we don't have yet at once. We collect the results in submission order, 
+    # so the output doesn't depend on which query finishes first
+    to_fetch = [(query_type, start_date, end_date) for start_date, end_date in time_periods for query_type in MIXPANEL_QUERY_TYPES if (query_type, start_date, end_date) not in cohorts]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(get_profiles_in_time_period, query_type, start_date, end_date, distinct_id_codes) for query_type, start_date, end_date in to_fetch]
+        for key, future in zip(to_fetch, futures):
+            cohorts[key] = future.result()
+            if cohort_store is not None:
+                save_cohort_to_store(cohort_store, *key, cohorts[key], distinct_id_codes)
+
+    if cohort_store is not None:
+        cohort_store.close()
+
+    users_in_time_periods = [
+        build_users_in_time_period(start_date, end_date, cohorts[('first_seen', start_date, end_date)], cohorts[('any_event', start_date, end_date)])
+        for start_date, end_date in time_periods
+    ]
 
     signup_data = get_mixpanel_signup_data(users_in_time_periods)
     retention_data = get_mixpanel_retention_data(users_in_time_periods)
 
     return signup_data, retention_data
 
-if __name__ == '__main__':
+# Instead of two /engage cohort queries per month, the raw event export can be read once into a local index
+# of the days each user did anything, and every cohort computed from that at any granularity
+MIXPANEL_SOURCE = os.environ.get('MIXPANEL_SOURCE', 'engage')
+MIXPANEL_ACTIVITY_INDEX_PATH = os.environ.get('MIXPANEL_ACTIVITY_INDEX_PATH', 'mixpanel_activity.sqlite')
+MIXPANEL_EXPORT_PATH = os.environ.get('MIXPANEL_EXPORT_PATH')
+# A user's cohort is the first day they are in the index, so the export has to go back to the project's first
+# event. By default it starts at the earliest day Mixpanel's export accepts, which is empty for any later project
+MIXPANEL_EXPORT_START_DATE = datetime.date.fromisoformat(os.environ.get('MIXPANEL_EXPORT_START_DATE', '2011-07-10'))
+# Cohorts start where the /engage ones do, and users first seen before then are in none of them
+MIXPANEL_COHORT_START_DATE = datetime.date(2022, 1, 1)
+MIXPANEL_EXPORT_LOOKBACK_DAYS = int(os.environ.get('MIXPANEL_EXPORT_LOOKBACK_DAYS', 5))
+MIXPANEL_EXPORT_BATCH_SIZE = int(os.environ.get('MIXPANEL_EXPORT_BATCH_SIZE', 100_000))
+# /engage counts a first-seen profile with an $email as a signup, but events don't carry profile properties,
+# so the event that marks a signup has to be named. There is no default, so the meaning never changes unnoticed
+MIXPANEL_SIGNUP_EVENT = os.environ.get('MIXPANEL_SIGNUP_EVENT')
+
+CohortGranularity = Literal['daily', 'weekly', 'monthly']
+MIXPANEL_COHORT_GRANULARITY: CohortGranularity = os.environ.get('MIXPANEL_COHORT_GRANULARITY', 'monthly') # type: ignore
+COHORT_GRANULARITY_FREQUENCIES: Dict[CohortGranularity, str] = {'daily': 'D', 'weekly': 'W-MON', 'monthly': 'MS'}
+COHORT_GRANULARITY_LABELS: Dict[CohortGranularity, str] = {'daily': 'Day', 'weekly': 'Week', 'monthly': 'Month'}
+
+EPOCH_DATE = datetime.date(1970, 1, 1)
+
+class UserActivity(TypedDict):
+    # One row for each day a user did anything, sorted by user and then day, with days counted from 1970-01-01
+    user_codes: np.ndarray
+    days: np.ndarray
+    # Indexed by code, whether the user ever finished signing up
+    signed_up: np.ndarray
+
+def iter_mixpanel_export_lines(from_date: datetime.date, to_date: datetime.date) -> Iterator[bytes]:
+    if MIXPANEL_EXPORT_PATH is not None:
+        # An export already on disk, like a backfill, is read whole instead of calling the API
+        with (gzip.open if MIXPANEL_EXPORT_PATH.endswith('.gz') else open)(MIXPANEL_EXPORT_PATH, 'rb') as f:
+            yield from f
+        return
+
+    service_account_username = get_secret('MIXPANEL_SERVICE_ACCOUNT_USERNAME')
+    service_account_password = get_secret('MIXPANEL_SERVICE_ACCOUNT_PASSWORD')
+    params = {'project_id': get_secret('MIXPANEL_PROJECT_ID'), 'from_date': from_date.isoformat(), 'to_date': to_date.isoformat()}
+
+    with mixpanel_concurrent_queries:
+        # Streamed and decompressed as it is read, so the export is never held in memory
+        response = http_client.request(
+            'GET', MIXPANEL_EXPORT_API_URL + 'export', endpoint='mixpanel export', before_attempt=mixpanel_rate_limiter.acquire, 
+            params=params, auth=(service_account_username, service_account_password), stream=True
+        )
+        with response:
+            yield from response.iter_lines(chunk_size=1 << 20)
+
+def open_mixpanel_activity_index(path: str) -> sqlite3.Connection:
+    con = sqlite3.connect(path)
+    # Without rowids the primary key is the table, which keeps a row per user per day as small as it gets
+    con.execute('CREATE TABLE IF NOT EXISTS activity (distinct_id TEXT, day INTEGER, PRIMARY KEY (distinct_id, day)) WITHOUT ROWID')
+    con.execute('CREATE TABLE IF NOT EXISTS signups (distinct_id TEXT PRIMARY KEY) WITHOUT ROWID')
+    con.execute('CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value INTEGER)')
+    return con
+
+def save_mixpanel_activity(con: sqlite3.Connection, activity: Set[Tuple[DistinctID, int]], signups: Set[DistinctID]) -> None:
+    with con:
+        con.executemany('INSERT OR IGNORE INTO activity VALUES (?, ?)', activity)
+        con.executemany('INSERT OR IGNORE INTO signups VALUES (?)', ((distinct_id,) for distinct_id in signups))
+
+def iter_mixpanel_export_events(lines: Iterable[bytes], lines_per_parse: int=10_000) -> Iterator[Dict[str, Any]]:
+    # One json.loads over a block of lines is several times faster than one per line
+    lines = iter(lines)
+    while True:
+        block = [line for line in itertools.islice(lines, lines_per_parse) if line.strip()]
+        if len(block) == 0:
+            return
+        yield from json.loads(b'[' + b','.join(block) + b']')
+
+def index_mixpanel_events(con: sqlite3.Connection, lines: Iterable[bytes], signup_event: str, batch_size: int=MIXPANEL_EXPORT_BATCH_SIZE) -> int:
+    # A user does many things in a day, so events are deduplicated into a batch of user days, 
+    # and only that batch is ever in memory
+    activity: Set[Tuple[DistinctID, int]] = set()
+    signups: Set[DistinctID] = set()
+    num_events = 0
+    for event in iter_mixpanel_export_events(lines):
+        properties = event['properties']
+        distinct_id = properties.get('distinct_id')
+        if distinct_id is None:
+            continue
+
+        activity.add((distinct_id, int(properties['time']) // 86400))
+        if event['event'] == signup_event:
+            signups.add(distinct_id)
+        num_events += 1
+
+        if len(activity) >= batch_size:
+            save_mixpanel_activity(con, activity, signups)
+            activity, signups = set(), set()
+
+    save_mixpanel_activity(con, activity, signups)
+    return num_events
+
+@instrumentation.timed('extract')
+def sync_mixpanel_activity_index(con: sqlite3.Connection, signup_event: str) -> int:
+    # Every day is only exported again while it is inside the look-back window, to pick up late events.
+    # Re-indexing a day is harmless, as user days are only ever added
+    # An index that doesn't go back as far as the start date, or doesn't record how far it goes, is filled in from the start
+    last_exported_day = con.execute("SELECT value FROM sync_state WHERE key = 'last_exported_day'").fetchone()
+    first_exported_day = con.execute("SELECT value FROM sync_state WHERE key = 'first_exported_day'").fetchone()
+    start_day = (MIXPANEL_EXPORT_START_DATE - EPOCH_DATE).days
+    from_date = MIXPANEL_EXPORT_START_DATE
+    # Signups recorded for a different event don't count, so they are dropped and found again from the start
+    indexed_signup_event = con.execute("SELECT value FROM sync_state WHERE key = 'signup_event'").fetchone()
+    if indexed_signup_event is None or indexed_signup_event[0] != signup_event:
+        with con:
+            con.execute('DELETE FROM signups')
+            con.execute("DELETE FROM sync_state WHERE key = 'first_exported_day'")
+        first_exported_day = None
+    if last_exported_day is not None and first_exported_day is not None and first_exported_day[0] <= start_day:
+        from_date = max(from_date, EPOCH_DATE + timedelta(days=last_exported_day[0] - MIXPANEL_EXPORT_LOOKBACK_DAYS))
+    to_date = datetime.date.today()
+
+    num_events = index_mixpanel_events(con, iter_mixpanel_export_lines(from_date, to_date), signup_event)
+    with con:
+        con.execute("INSERT OR REPLACE INTO sync_state VALUES ('last_exported_day', ?)", ((to_date - EPOCH_DATE).days,))
+        con.execute("INSERT OR REPLACE INTO sync_state VALUES ('signup_event', ?)", (signup_event,))
+        if from_date == MIXPANEL_EXPORT_START_DATE:
+            con.execute("INSERT OR REPLACE INTO sync_state VALUES ('first_exported_day', ?)", (start_day,))
+    return num_events
+
+def read_mixpanel_activity_index(con: sqlite3.Connection, batch_size: int=MIXPANEL_EXPORT_BATCH_SIZE) -> UserActivity:
+    # Users are read in order into a fresh set of codes, so the codes come out sorted along with the rows
+    distinct_id_codes = DistinctIdCodes()
+    code_batches: List[np.ndarray] = []
+    day_batches: List[np.ndarray] = []
+    cur = con.execute('SELECT distinct_id, day FROM activity ORDER BY distinct_id, day')
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if len(rows) == 0:
+            break
+        code_batches.append(distinct_id_codes.intern([distinct_id for distinct_id, _ in rows]))
+        day_batches.append(np.fromiter((day for _, day in rows), dtype=np.int32, count=len(rows)))
+
+    signup_codes = distinct_id_codes.intern([distinct_id for distinct_id, in con.execute('SELECT distinct_id FROM signups')])
+    signed_up = np.zeros(len(distinct_id_codes.distinct_ids), dtype=bool)
+    signed_up[signup_codes] = True
+
+    return {
+        'user_codes': np.concatenate(code_batches) if len(code_batches) > 0 else np.empty(0, dtype=np.int32),
+        'days': np.concatenate(day_batches) if len(day_batches) > 0 else np.empty(0, dtype=np.int32),
+        'signed_up': signed_up,
+    }
+
+def get_period_start_days(days: np.ndarray, granularity: CohortGranularity) -> np.ndarray:
+    if granularity == 'daily':
+        return days
+    if granularity == 'weekly':
+        # 1970-01-01 was a Thursday, so this moves every day back to the Monday it falls after
+        return days - (days + 3) % 7
+    return days.astype('datetime64[D]').astype('datetime64[M]').astype('datetime64[D]').astype(days.dtype)
+
+@instrumentation.timed('transform')
+def get_mixpanel_cohort_data(activity: UserActivity, granularity: CohortGranularity='monthly', start_date: datetime.date=MIXPANEL_COHORT_START_DATE) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    label = COHORT_GRANULARITY_LABELS[granularity]
+
+    # Rows are sorted by user and then day, so each user's first row is the day they were first seen. Like
+    # $mp_first_event_time on /engage, that leaves users first seen before the start date out of every cohort
+    user_codes, days = activity['user_codes'], activity['days']
+    _, first_rows, user_indexes = np.unique(user_codes, return_index=True, return_inverse=True)
+    in_cohorts = days[first_rows][user_indexes.reshape(-1)] >= (start_date - EPOCH_DATE).days
+    user_codes, days = user_codes[in_cohorts], days[in_cohorts]
+
+    if len(days) == 0:
+        return pd.DataFrame(columns=[label, 'Num Signups', 'Num Installs', 'Install Success Rate']), pd.DataFrame(columns=['Start Date', 'End Date', 'Initial Size'])
+
+    periods = get_period_start_days(days, granularity)
+    period_starts = pd.date_range(pd.Timestamp(int(periods.min()), unit='D'), pd.Timestamp(int(periods.max()), unit='D'), freq=COHORT_GRANULARITY_FREQUENCIES[granularity])
+    period_days = period_starts.values.astype('datetime64[D]').astype(np.int64)
+    num_periods = len(period_starts)
+    period_indexes = np.searchsorted(period_days, periods)
+
+    # Each user's first row is the period they were first seen in
+    users, first_rows = np.unique(user_codes, return_index=True)
+    cohorts = period_indexes[first_rows]
+
+    num_installs = np.bincount(cohorts, minlength=num_periods)
+    num_signups = np.bincount(cohorts[activity['signed_up'][users]], minlength=num_periods)
+    signup_data = pd.DataFrame({
+        label: period_starts,
+        'Num Signups': num_signups,
+        'Num Installs': num_installs,
+        'Install Success Rate': np.divide(num_signups, num_installs, out=np.zeros(num_periods), where=num_installs > 0),
+    })
+
+    # One key per user per period they were active in. The keys are already sorted, so dropping
+    # repeats only needs a comparison with the key before
+    user_indexes = np.searchsorted(users, user_codes)
+    keys = user_indexes.astype(np.int64) * num_periods + period_indexes
+    keys = keys[np.concatenate(([True], keys[1:] != keys[:-1]))]
+    cells = cohorts[keys // num_periods] * num_periods + keys % num_periods
+    num_retained = np.bincount(cells, minlength=num_periods * num_periods).reshape(num_periods, num_periods)
+
+    retention_data = pd.DataFrame(num_retained, columns=list(period_starts))
+    retention_data.insert(0, 'Start Date', period_starts)
+    retention_data.insert(1, 'End Date', period_starts.shift(1))
+    retention_data.insert(2, 'Initial Size', num_installs)
+    return signup_data, retention_data
+
+# The wide retention table gains a column every period, which only works for the monthly tables the dashboard
+# reads. Daily and weekly cohorts go in tables of a fixed shape instead, with retention one row per cell
+MIXPANEL_LONG_COHORT_TABLES: Dict[str, str] = {
+    'SIGNUPS': '(period_start TIMESTAMP_NTZ, num_signups NUMBER, num_installs NUMBER, install_success_rate FLOAT)',
+    'RETENTION': '(start_date TIMESTAMP_NTZ, end_date TIMESTAMP_NTZ, initial_size NUMBER, period_start TIMESTAMP_NTZ, num_retained NUMBER)',
+}
+
+def get_mixpanel_retention_long_format(retention_data: pd.DataFrame) -> pd.DataFrame:
+    # One row for each cohort and each period from its start on, in the order of the RETENTION table's columns
+    long_format = retention_data.melt(id_vars=['Start Date', 'End Date', 'Initial Size'], var_name='Period Start', value_name='Num Retained')
+    long_format['Period Start'] = pd.to_datetime(long_format['Period Start'])
+    long_format = long_format[long_format['Period Start'] >= long_format['Start Date']]
+    return long_format.sort_values(['Start Date', 'Period Start'], ignore_index=True)
+
+def create_mixpanel_long_cohort_tables(conn: snowflake.connector.SnowflakeConnection, table_suffix: str) -> None:
+    for table, columns in MIXPANEL_LONG_COHORT_TABLES.items():
+        conn.cursor().execute(f'CREATE TABLE IF NOT EXISTS DASHBOARD_DATA.MIXPANEL.{table}{table_suffix} {columns}')
+
+def get_mixpanel_data_from_export(granularity: CohortGranularity=MIXPANEL_COHORT_GRANULARITY, activity_index_path: str=MIXPANEL_ACTIVITY_INDEX_PATH, signup_event: Optional[str]=MIXPANEL_SIGNUP_EVENT) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    if signup_event is None:
+        raise ValueError('Set MIXPANEL_SIGNUP_EVENT to the event that marks a signup to read cohorts from the event export')
+
+    con = open_mixpanel_activity_index(activity_index_path)
+    try:
+        sync_mixpanel_activity_index(con, signup_event)
+        activity = read_mixpanel_activity_index(con)
+    finally:
+        con.close()
+
+    return get_mixpanel_cohort_data(activity, granularity)
+
+# Each stage is an extract -> transform -> write chain that doesn't depend on any other stage
+PIPELINE_MAX_ATTEMPTS = int(os.environ.get('PIPELINE_MAX_ATTEMPTS', 3))
+PIPELINE_RETRY_BASE_SECONDS = float(os.environ.get('PIPELINE_RETRY_BASE_SECONDS', 30))
+
+PipelineStage = Callable[[snowflake.connector.SnowflakeConnection], List[WriteResult]]
+
+class StageResult(TypedDict):
+    stage: str
+    succeeded: bool
+    attempts: int
+    seconds: float
+    write_results: List[WriteResult]
+    error: Optional[str]
+
+def run_brex_accounts_stage(conn: snowflake.connector.SnowflakeConnection) -> List[WriteResult]:
     account_data = get_brex_account_data()
-    write_df_to_snowflake(account_data, 'COMPUTE_WH', 'DASHBOARD_DATA', 'BREX', 'ACCOUNT_DATA', clear_table=True)
-    tx_data = get_brex_transaction_data()
-    write_df_to_snowflake(tx_data, 'COMPUTE_WH', 'DASHBOARD_DATA', 'BREX', 'TRANSACTION_DATA', clear_table=True)
+    return [write_df_to_snowflake(account_data, 'COMPUTE_WH', 'DASHBOARD_DATA', 'BREX', 'ACCOUNT_DATA', clear_table=True, conn=conn)]
+
+def run_brex_transactions_stage(conn: snowflake.connector.SnowflakeConnection, full_refresh: bool=False) -> List[WriteResult]:
+    # The rollups are built from the synced and categorized table, so they belong to the same stage
+    write_results = [categorize_stored_brex_transactions(conn), sync_brex_transaction_data(full_refresh=full_refresh, conn=conn)]
+    return write_results + materialize_monthly_finance_tables(conn=conn)
+
+def run_stripe_stage(conn: snowflake.connector.SnowflakeConnection) -> List[WriteResult]:
     stripe_subscriptions = get_stripe_subscriptions()
-    write_df_to_snowflake(stripe_subscriptions, 'COMPUTE_WH', 'DASHBOARD_DATA', 'STRIPE', 'SUBSCRIPTIONS', clear_table=True)
-    mixpanel_signups, retention_data = get_mixpanel_data()
-    write_df_to_snowflake(mixpanel_signups, 'COMPUTE_WH', 'DASHBOARD_DATA', 'MIXPANEL', 'SIGNUPS', clear_table=True)
-    write_df_to_snowflake(retention_data, 'COMPUTE_WH', 'DASHBOARD_DATA', 'MIXPANEL', 'RETENTION', clear_table=True)
-    
+    return [write_df_to_snowflake(stripe_subscriptions, 'COMPUTE_WH', 'DASHBOARD_DATA', 'STRIPE', 'SUBSCRIPTIONS', clear_table=True, conn=conn)]
+
+def run_mixpanel_stage(conn: snowflake.connector.SnowflakeConnection) -> List[WriteResult]:
+    table_suffix = ''
+    if MIXPANEL_SOURCE == 'export':
+        mixpanel_signups, retention_data = get_mixpanel_data_from_export()
+        # Monthly cohorts go in the tables the dashboard reads, and any other granularity in its own
+        if MIXPANEL_COHORT_GRANULARITY != 'monthly':
+            table_suffix = '_' + MIXPANEL_COHORT_GRANULARITY.upper()
+            create_mixpanel_long_cohort_tables(conn, table_suffix)
+            retention_data = get_mixpanel_retention_long_format(retention_data)
+    else:
+        mixpanel_signups, retention_data = get_mixpanel_data()
+
+    return [
+        # The Mixpanel frames are labelled for reading, like "Num Signups" and the period start dates, so they go in by position
+        write_df_to_snowflake(mixpanel_signups, 'COMPUTE_WH', 'DASHBOARD_DATA', 'MIXPANEL', 'SIGNUPS' + table_suffix, clear_table=True, conn=conn, by_name=False),
+        write_df_to_snowflake(retention_data, 'COMPUTE_WH', 'DASHBOARD_DATA', 'MIXPANEL', 'RETENTION' + table_suffix, clear_table=True, conn=conn, by_name=False),
+    ]
+
+def get_pipeline_stages(full_refresh: bool=False) -> Dict[str, PipelineStage]:
+    return {
+        'brex_accounts': run_brex_accounts_stage,
+        'brex_transactions': lambda conn: run_brex_transactions_stage(conn, full_refresh=full_refresh),
+        'stripe': run_stripe_stage,
+        'mixpanel': run_mixpanel_stage,
+    }
+
+def run_pipeline_stage(name: str, stage: PipelineStage, max_attempts: int=PIPELINE_MAX_ATTEMPTS) -> StageResult:
+    start = time.perf_counter()
+    error: Optional[str] = None
+    for attempt in range(1, max_attempts + 1):
+        try:
+            # Every stage has its own connection, so stages never share a session across threads
+            conn = get_snowflake_connection('COMPUTE_WH', 'DASHBOARD_DATA')
+            try:
+                with instrumentation.measure('stage', name):
+                    write_results = stage(conn)
+            finally:
+                conn.close()
+            return {'stage': name, 'succeeded': True, 'attempts': attempt, 'seconds': time.perf_counter() - start, 'write_results': write_results, 'error': None}
+        except Exception as e:
+            # Every write is a swap or a merge, so a stage can safely be re-run from the start
+            error = f'{type(e).__name__}: {e}'
+            if attempt < max_attempts:
+                backoff = PIPELINE_RETRY_BASE_SECONDS * 2 ** (attempt - 1)
+                print(f'{name}: attempt {attempt} failed with {error}, retrying in {backoff:.0f}s', flush=True)
+                time.sleep(backoff)
+
+    return {'stage': name, 'succeeded': False, 'attempts': max_attempts, 'seconds': time.perf_counter() - start, 'write_results': [], 'error': error}
+
+def run_pipeline(stages: Dict[str, PipelineStage], max_attempts: int=PIPELINE_MAX_ATTEMPTS) -> List[StageResult]:
+    # The stages are independent, so the whole run takes as long as the slowest one
+    with ThreadPoolExecutor(max_workers=max(1, len(stages))) as executor:
+        futures = [executor.submit(run_pipeline_stage, name, stage, max_attempts) for name, stage in stages.items()]
+        return [future.result() for future in futures]
+
+def print_pipeline_report(stage_results: List[StageResult]) -> None:
+    for stage_result in stage_results:
+        status = 'ok' if stage_result['succeeded'] else f"failed ({stage_result['error']})"
+        print(f"{stage_result['stage']}: {status} after {stage_result['attempts']} attempt(s) in {stage_result['seconds']:.1f}s")
+        for write_result in stage_result['write_results']:
+            print(f"  {write_result['table']}: wrote {write_result['rows']} rows in {write_result['seconds']:.1f}s")
+
+    for endpoint, stats in sorted(http_client.get_endpoint_stats().items()):
+        average_ms = stats['seconds'] / stats['requests'] * 1000
+        print(
+            f"{endpoint}: {stats['requests']} requests ({stats['retries']} retries, {stats['failures']} failures), "
+            f"{average_ms:.0f}ms average, {stats['bytes_received'] / 1e6:.1f}MB received ({stats['bytes_decoded'] / 1e6:.1f}MB decoded)"
+        )
 
 
+if __name__ == '__main__':
+    stage_names = list(get_pipeline_stages().keys())
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--full-refresh', action='store_true', help='Reload every Brex transaction instead of only the new ones')
+    parser.add_argument('--stage', action='append', choices=stage_names, help='Only run this stage; can be given more than once. Defaults to every stage')
+    parser.add_argument('--max-attempts', type=int, default=PIPELINE_MAX_ATTEMPTS, help='How many times to try each stage before giving up on it')
+    parser.add_argument('--metrics-jsonl', help='Append every timing measurement from this run to this file, one JSON object per line')
+    parser.add_argument('--metrics-prometheus', help='Write a summary of this run\'s timings to this file in the Prometheus text format')
+    args = parser.parse_args()
+
+    stages = get_pipeline_stages(full_refresh=args.full_refresh)
+    selected_stages = {name: stages[name] for name in (args.stage or stage_names)}
+
+    stage_results = run_pipeline(selected_stages, max_attempts=args.max_attempts)
+    print_pipeline_report(stage_results)
+
+    if args.metrics_jsonl is not None:
+        instrumentation.write_measurements_jsonl(args.metrics_jsonl, instrumentation.get_measurements())
+    if args.metrics_prometheus is not None:
+        instrumentation.write_prometheus_text(args.metrics_prometheus, instrumentation.get_measurements(), prefix='dashboard_loader')
+
+    if not all(stage_result['succeeded'] for stage_result in stage_results):
+        raise SystemExit(1)
@@ -1,16 +1,27 @@
+import hashlib
 import json
 import logging
 import os
-from datetime import datetime, timedelta
-from typing import Any, Dict, List, Literal, Optional, Tuple, Union
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from typing import Any, Callable, Dict, Iterator, List, Literal, Optional, Tuple, TypedDict
 
 import numpy as np
 import pandas as pd
 import plotly.express as px
-import requests
+import pyarrow as pa
+import pyarrow.feather as feather
 import snowflake.connector
 import streamlit as st
 from dateutil import rrule
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+import http_client
+import instrumentation
 
 logging.getLogger('snowflake.connector').setLevel(logging.WARNING)
 logging.getLogger('stripe').setLevel(logging.WARNING)
@@ -26,22 +37,280 @@ def get_secret(key):
     else:
         return st.secrets[key]
 
-def get_snowflake_table_as_df(schema: str, table: str) -> pd.DataFrame:
-    con = snowflake.connector.connect(
+SNOWFLAKE_POOL_SIZE = int(os.environ.get('SNOWFLAKE_POOL_SIZE', 4))
+SNOWFLAKE_CACHE_TTL_SECONDS = int(os.environ.get('SNOWFLAKE_CACHE_TTL_SECONDS', 10 * 60))
+
+# Every table read is also kept on disk, so a cold start renders from the last snapshot rather than waiting 
+# on the warehouse. Set this to an empty string to always read from Snowflake
+SNOWFLAKE_SNAPSHOT_DIR = os.environ.get('SNOWFLAKE_SNAPSHOT_DIR', 'snowflake_snapshots')
+SNOWFLAKE_SNAPSHOT_POLL_SECONDS = int(os.environ.get('SNOWFLAKE_SNAPSHOT_POLL_SECONDS', 5))
+
+# A filter is (column, operator, value); the value is always sent as a bind parameter
+SnowflakeFilter = Tuple[str, str, Any]
+# A date range is (column, start, end), with the start inclusive, the end exclusive, and either may be None
+SnowflakeDateRange = Tuple[str, Optional[date], Optional[date]]
+SNOWFLAKE_FILTER_OPERATORS: Dict[str, str] = {
+    '=': '{column} = %s',
+    '!=': '{column} != %s',
+    '<': '{column} < %s',
+    '<=': '{column} <= %s',
+    '>': '{column} > %s',
+    '>=': '{column} >= %s',
+    'abs <': 'ABS({column}) < %s',
+}
+
+
+def create_snowflake_connection() -> snowflake.connector.SnowflakeConnection:
+    # Pooled connections can sit idle for hours, and is_closed() doesn't notice a session that expired,
+    # so the session is kept alive for as long as the connection is open
+    return snowflake.connector.connect(
         user=get_secret('SNOWFLAKE_USERNAME'), 
         password=get_secret('SNOWFLAKE_PASSWORD'), 
         account=get_secret('SNOWFLAKE_ACCOUNT'), 
         warehouse='COMPUTE_WH', 
         database='DASHBOARD_DATA', 
-        schema=schema
+        client_session_keep_alive=True,
     )
 
-    cur = con.cursor()
-    cur.execute(f'SELECT * FROM {table}')
-    df = cur.fetch_pandas_all()
+@st.cache_resource
+def get_snowflake_connection_pool() -> 'queue.LifoQueue[snowflake.connector.SnowflakeConnection]':
+    # Shared by every session and rerun for the life of the process
+    return queue.LifoQueue(maxsize=SNOWFLAKE_POOL_SIZE)
+
+@contextmanager
+def pooled_snowflake_connection() -> Iterator[snowflake.connector.SnowflakeConnection]:
+    pool = get_snowflake_connection_pool()
+    try:
+        con = pool.get_nowait()
+        if con.is_closed():
+            con = create_snowflake_connection()
+    except queue.Empty:
+        con = create_snowflake_connection()
+
+    try:
+        yield con
+    except Exception:
+        # Don't hand a connection in an unknown state to the next reader
+        con.close()
+        raise
+
+    try:
+        pool.put_nowait(con)
+    except queue.Full:
+        con.close()
+
+@st.cache_resource
+def get_snowflake_table_versions() -> Dict[str, int]:
+    # Bumping a table's version changes the cache key, so only that table is re-read
+    return {}
+
+def invalidate_snowflake_table(schema: Optional[str]=None, table: Optional[str]=None) -> None:
+    if schema is None or table is None:
+        # Also check every snapshot against Snowflake again on its next read
+        get_snowflake_snapshot_state()['checked_at'].clear()
+        read_snowflake_table.clear()
+        return
+
+    table_versions = get_snowflake_table_versions()
+    key = f'{schema}.{table}'
+    table_versions[key] = table_versions.get(key, 0) + 1
+
+def check_snowflake_identifier(identifier: str) -> str:
+    # Identifiers can't be bound, so anything interpolated into the query must be a plain name
+    if not identifier.isidentifier():
+        raise ValueError(f'Invalid Snowflake identifier: {identifier!r}')
+    return identifier
+
+def build_snowflake_select(
+        schema: str, 
+        table: str, 
+        columns: Optional[Tuple[str, ...]]=None, 
+        filters: Optional[Tuple[SnowflakeFilter, ...]]=None, 
+        date_range: Optional[SnowflakeDateRange]=None
+    ) -> Tuple[str, List[Any]]:
+    select_list = '*' if columns is None else ', '.join(check_snowflake_identifier(column) for column in columns)
+
+    predicates: List[str] = []
+    params: List[Any] = []
+    for column, operator, value in filters or ():
+        if operator not in SNOWFLAKE_FILTER_OPERATORS:
+            raise ValueError(f'Unsupported Snowflake filter operator: {operator!r}')
+        predicates.append(SNOWFLAKE_FILTER_OPERATORS[operator].format(column=check_snowflake_identifier(column)))
+        params.append(value)
+
+    if date_range is not None:
+        column, start, end = date_range
+        if start is not None:
+            predicates.append(f'{check_snowflake_identifier(column)} >= %s')
+            params.append(start)
+        if end is not None:
+            predicates.append(f'{check_snowflake_identifier(column)} < %s')
+            params.append(end)
+
+    query = f'SELECT {select_list} FROM {check_snowflake_identifier(schema)}.{check_snowflake_identifier(table)}'
+    if predicates:
+        query += ' WHERE ' + ' AND '.join(predicates)
+    return query, params
+
+def query_snowflake_table(
+        schema: str, 
+        table: str, 
+        columns: Optional[Tuple[str, ...]]=None, 
+        filters: Optional[Tuple[SnowflakeFilter, ...]]=None, 
+        date_range: Optional[SnowflakeDateRange]=None
+    ) -> pd.DataFrame:
+    query, params = build_snowflake_select(schema, table, columns, filters, date_range)
+    with pooled_snowflake_connection() as con:
+        cur = con.cursor()
+        cur.execute(query, params)
+        df = cur.fetch_pandas_all()
+
     df.columns = [col.lower() for col in df.columns]
     return df
 
+def get_snowflake_table_last_altered(schema: str, table: str) -> Optional[datetime]:
+    with pooled_snowflake_connection() as con:
+        cur = con.cursor()
+        cur.execute('SELECT LAST_ALTERED FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s', (schema, table))
+        row = cur.fetchone()
+    return row[0] if row is not None else None
+
+class SnowflakeSnapshotState(TypedDict):
+    lock: threading.Lock
+    in_flight: Dict[str, 'Future[None]']
+    checked_at: Dict[str, float]
+    generation: int
+
+@st.cache_resource
+def get_snowflake_snapshot_state() -> SnowflakeSnapshotState:
+    # Shared by every session, so each snapshot is refreshed once no matter how many sessions read it
+    return {'lock': threading.Lock(), 'in_flight': {}, 'checked_at': {}, 'generation': 0}
+
+def get_snowflake_snapshot_path(
+        schema: str, 
+        table: str, 
+        columns: Optional[Tuple[str, ...]], 
+        filters: Optional[Tuple[SnowflakeFilter, ...]], 
+        date_range: Optional[SnowflakeDateRange]
+    ) -> str:
+    query_hash = hashlib.sha1(repr((columns, filters, date_range)).encode()).hexdigest()[:12]
+    return os.path.join(SNOWFLAKE_SNAPSHOT_DIR, f'{schema}.{table}.{query_hash}.arrow')
+
+def read_snowflake_snapshot(path: str) -> Optional[Tuple[pd.DataFrame, Optional[datetime]]]:
+    # Uncompressed Arrow IPC, so the file is memory mapped rather than read and decoded
+    try:
+        arrow_table = feather.read_table(path, memory_map=True)
+    except (OSError, pa.ArrowInvalid):
+        return None
+
+    last_altered = (arrow_table.schema.metadata or {}).get(b'snowflake_last_altered', b'').decode()
+    return arrow_table.to_pandas(), datetime.fromisoformat(last_altered) if last_altered else None
+
+def write_snowflake_snapshot(path: str, df: pd.DataFrame, last_altered: Optional[datetime]) -> None:
+    arrow_table = pa.Table.from_pandas(df, preserve_index=False)
+    metadata = {**(arrow_table.schema.metadata or {}), b'snowflake_last_altered': (last_altered.isoformat() if last_altered is not None else '').encode()}
+
+    # Written to the side and renamed, so a reader never maps half a file
+    os.makedirs(SNOWFLAKE_SNAPSHOT_DIR, exist_ok=True)
+    temporary_path = f'{path}.{threading.get_ident()}.tmp'
+    feather.write_feather(arrow_table.replace_schema_metadata(metadata), temporary_path, compression='uncompressed')
+    os.replace(temporary_path, path)
+
+def refresh_snowflake_snapshot(
+        schema: str, 
+        table: str, 
+        columns: Optional[Tuple[str, ...]], 
+        filters: Optional[Tuple[SnowflakeFilter, ...]], 
+        date_range: Optional[SnowflakeDateRange],
+        snapshot_last_altered: Optional[datetime]=None
+    ) -> Optional[pd.DataFrame]:
+    # The table's last-altered time is read before the table, so a write in between is caught next time
+    path = get_snowflake_snapshot_path(schema, table, columns, filters, date_range)
+    last_altered = get_snowflake_table_last_altered(schema, table)
+    get_snowflake_snapshot_state()['checked_at'][path] = time.time()
+    if last_altered is not None and snapshot_last_altered is not None and last_altered <= snapshot_last_altered:
+        return None
+
+    df = query_snowflake_table(schema, table, columns, filters, date_range)
+    write_snowflake_snapshot(path, df, last_altered)
+    return df
+
+def schedule_snowflake_snapshot_refresh(
+        schema: str, 
+        table: str, 
+        columns: Optional[Tuple[str, ...]], 
+        filters: Optional[Tuple[SnowflakeFilter, ...]], 
+        date_range: Optional[SnowflakeDateRange],
+        snapshot_last_altered: Optional[datetime]
+    ) -> None:
+    state = get_snowflake_snapshot_state()
+    path = get_snowflake_snapshot_path(schema, table, columns, filters, date_range)
+    ctx = get_script_run_ctx()
+
+    def refresh() -> None:
+        add_script_run_ctx(threading.current_thread(), ctx)
+        with instrumentation.measure('snapshot_refresh', f'{schema}.{table}') as measurement:
+            df = refresh_snowflake_snapshot(schema, table, columns, filters, date_range, snapshot_last_altered)
+            measurement.update(instrumentation.describe_result(df)) # type: ignore
+
+        # Newer data landed, so the next read picks up the new snapshot and every open page reruns
+        if df is not None:
+            invalidate_snowflake_table(schema, table)
+            with state['lock']:
+                state['generation'] += 1
+
+    # Each snapshot is checked at most once a cache lifetime, even when a refresh invalidates it
+    with state['lock']:
+        in_flight = path in state['in_flight'] and not state['in_flight'][path].done()
+        checked_recently = time.time() - state['checked_at'].get(path, 0) < SNOWFLAKE_CACHE_TTL_SECONDS
+        if not in_flight and not checked_recently:
+            state['in_flight'][path] = get_prefetch_executor().submit(refresh)
+
+@st.fragment(run_every=SNOWFLAKE_SNAPSHOT_POLL_SECONDS)
+def rerun_on_new_snowflake_snapshots() -> None:
+    generation = get_snowflake_snapshot_state()['generation']
+    if st.session_state.setdefault('snowflake_snapshot_generation', generation) != generation:
+        st.session_state['snowflake_snapshot_generation'] = generation
+        st.rerun()
+
+@st.cache_data(ttl=SNOWFLAKE_CACHE_TTL_SECONDS, show_spinner=False)
+def read_snowflake_table(
+        schema: str, 
+        table: str, 
+        version: int, 
+        columns: Optional[Tuple[str, ...]]=None, 
+        filters: Optional[Tuple[SnowflakeFilter, ...]]=None, 
+        date_range: Optional[SnowflakeDateRange]=None
+    ) -> pd.DataFrame:
+    instrumentation.note_cache_miss()
+    if not SNOWFLAKE_SNAPSHOT_DIR:
+        df = query_snowflake_table(schema, table, columns, filters, date_range)
+    else:
+        # Stale while revalidate: the last snapshot is served straight away, and checked against Snowflake in the background
+        snapshot = read_snowflake_snapshot(get_snowflake_snapshot_path(schema, table, columns, filters, date_range))
+        if snapshot is None:
+            df = refresh_snowflake_snapshot(schema, table, columns, filters, date_range) # type: ignore
+        else:
+            df, snapshot_last_altered = snapshot
+            schedule_snowflake_snapshot_refresh(schema, table, columns, filters, date_range, snapshot_last_altered)
+
+    df.attrs['loaded_at'] = time.time()
+    return df
+
+def get_snowflake_table_as_df(
+        schema: str, 
+        table: str, 
+        columns: Optional[Tuple[str, ...]]=None, 
+        filters: Optional[Tuple[SnowflakeFilter, ...]]=None, 
+        date_range: Optional[SnowflakeDateRange]=None
+    ) -> pd.DataFrame:
+    # The projection and filters run in the warehouse, so only the rows and columns we need are transferred
+    version = get_snowflake_table_versions().get(f'{schema}.{table}', 0)
+    with instrumentation.measure('snowflake_read', f'{schema}.{table}', cached=True) as measurement:
+        df = read_snowflake_table(schema, table, version, columns, filters, date_range)
+        measurement.update(instrumentation.describe_result(df)) # type: ignore
+    return df
+
 
 def get_runway_string(balance: float, burn: float) -> str:
     if burn < 0:
@@ -49,23 +318,104 @@ def get_runway_string(balance: float, burn: float) -> str:
     return f'${round(burn)}, for a runway of {round(balance / burn / 12)} years.'
 
 
-def get_is_default_alive(starting_balance: float, revenue: float, expenses: float, revenue_growth_rate: float) -> bool:
+# Scenarios are only simulated this far out. One whose revenue can never pass its expenses is worked out from
+# the sum of its revenue instead, and one that can but neither runs out nor turns profitable by then is beyond the horizon
+RUNWAY_HORIZON_MONTHS = 600
+RUNWAY_SCENARIOS_PER_CHUNK = 4096
+# A scenario that hasn't run out after this many months never does
+RUNWAY_MAX_MONTHS_TO_ZERO = 2 ** 40
+
+def get_months_to_zero_without_profit(starting_balance: float, revenue: np.ndarray, expenses: np.ndarray, revenue_growth_rate: np.ndarray) -> np.ndarray:
+    # Revenue never passes expenses, so the balance never goes up and the first month the money runs out is
+    # found by bisection. The balance at the start of a month is the linear or geometric sum of the revenue before it
+    def is_out_of_money(months: np.ndarray) -> np.ndarray:
+        with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+            growth = np.where(revenue_growth_rate == 0, 1, revenue_growth_rate)
+            revenue_sum = np.where(revenue_growth_rate == 0, months, (np.power(1 + revenue_growth_rate, months) - 1) / growth)
+            balance = starting_balance - months * expenses + np.where(revenue == 0, 0, revenue * revenue_sum)
+            return (balance <= 0) | (balance - expenses < 0)
+
+    low = np.zeros(len(revenue), dtype=np.int64)
+    high = np.full(len(revenue), RUNWAY_MAX_MONTHS_TO_ZERO, dtype=np.int64)
+    never_out_of_money = ~is_out_of_money(high.astype(np.float64))
+    while (low < high).any():
+        middle = (low + high) // 2
+        out_of_money = is_out_of_money(middle.astype(np.float64))
+        high = np.where(out_of_money, middle, high)
+        low = np.where(out_of_money, low, middle + 1)
+
+    return np.where(never_out_of_money, np.inf, high.astype(np.float64))
+
+def get_months_to_zero_and_default_alive(starting_balance: float, revenue: np.ndarray, expenses: np.ndarray, revenue_growth_rate: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    months = np.arange(RUNWAY_HORIZON_MONTHS)
+    months_to_zero = np.empty(len(revenue))
+    default_alive = np.empty(len(revenue), dtype=bool)
+    beyond_horizon = np.empty(len(revenue), dtype=bool)
+
+    # We work through the scenarios in chunks, so memory stays bounded however many there are
+    for start in range(0, len(revenue), RUNWAY_SCENARIOS_PER_CHUNK):
+        chunk = slice(start, start + RUNWAY_SCENARIOS_PER_CHUNK)
+        chunk_expenses = expenses[chunk, None]
+
+        with np.errstate(over='ignore', invalid='ignore'):
+            # One row per scenario, one column per month
+            monthly_revenue = revenue[chunk, None] * (1 + revenue_growth_rate[chunk, None]) ** months
+            # The balance at the start of each month is what we started with, less the expenses and plus the revenue of every earlier month
+            balance = starting_balance - months * chunk_expenses + (np.cumsum(monthly_revenue, axis=1) - monthly_revenue)
+
+            profitable = monthly_revenue > chunk_expenses
+            no_money_left = balance <= 0
+            cannot_pay_expenses = balance - chunk_expenses < 0
+
+        first_profitable = np.where(profitable.any(axis=1), profitable.argmax(axis=1), RUNWAY_HORIZON_MONTHS)
+        first_no_money_left = np.where(no_money_left.any(axis=1), no_money_left.argmax(axis=1), RUNWAY_HORIZON_MONTHS)
+        first_cannot_pay_expenses = np.where(cannot_pay_expenses.any(axis=1), cannot_pay_expenses.argmax(axis=1), RUNWAY_HORIZON_MONTHS)
+
+        # Each month, we check we have money left, then whether revenue covers expenses, and then whether we can pay them
+        first_out_of_money = np.minimum(first_no_money_left, first_cannot_pay_expenses)
+        default_alive[chunk] = (first_profitable < first_no_money_left) & (first_profitable <= first_cannot_pay_expenses)
+        beyond_horizon[chunk] = (first_out_of_money == RUNWAY_HORIZON_MONTHS) & (first_profitable == RUNWAY_HORIZON_MONTHS)
+        # How long a scenario beyond the horizon lasts isn't known
+        months_to_zero[chunk] = np.where(first_out_of_money < RUNWAY_HORIZON_MONTHS, first_out_of_money, np.where(beyond_horizon[chunk], np.nan, np.inf))
+
+    # Shrinking or negative revenue peaks at its first month, or just under zero when it grows back towards it
+    peak_revenue = np.where((revenue <= 0) & (revenue_growth_rate < 0), 0, revenue)
+    never_profitable = ((revenue_growth_rate <= 0) | (revenue <= 0)) & (peak_revenue <= expenses)
+    months_to_zero[never_profitable] = get_months_to_zero_without_profit(
+        starting_balance, revenue[never_profitable], expenses[never_profitable], revenue_growth_rate[never_profitable]
+    )
+    default_alive[never_profitable] = False
+    beyond_horizon[never_profitable] = False
 
-    current_balance = starting_balance
-    current_revenue = revenue
-    while current_balance > 0:
-        if (current_revenue > expenses):
-            return True
+    return months_to_zero, default_alive, beyond_horizon
 
-        current_balance -= expenses
+@instrumentation.timed('compute')
+def get_runway_scenarios(starting_balance: float, revenues: List[float], gross_burns: List[float], revenue_growth_rates: List[float], salary_adjustments: List[float]) -> pd.DataFrame:
+    # Every combination of the assumptions, evaluated at once
+    revenue, gross_burn, revenue_growth_rate, salary_adjustment = [
+        grid.ravel() for grid in np.meshgrid(revenues, gross_burns, revenue_growth_rates, salary_adjustments, indexing='ij')
+    ]
+    months_to_zero, default_alive, beyond_horizon = get_months_to_zero_and_default_alive(starting_balance, revenue, gross_burn + salary_adjustment, revenue_growth_rate)
 
-        if current_balance < 0:
-            return False
+    return pd.DataFrame({
+        'revenue': revenue,
+        'gross_burn': gross_burn,
+        'revenue_growth_rate': revenue_growth_rate,
+        'salary_adjustment': salary_adjustment,
+        'months_to_zero': months_to_zero,
+        'default_alive': default_alive,
+        'beyond_horizon': beyond_horizon,
+    })
 
-        current_balance += current_revenue
-        current_revenue =  current_revenue * (1 + revenue_growth_rate)
+def get_is_default_alive(starting_balance: float, revenue: float, expenses: float, revenue_growth_rate: float) -> Optional[bool]:
+    # None when the scenario is beyond the horizon, as we can't tell either way
+    _, default_alive, beyond_horizon = get_months_to_zero_and_default_alive(starting_balance, np.array([revenue]), np.array([expenses]), np.array([revenue_growth_rate]))
+    return None if beyond_horizon[0] else bool(default_alive[0])
 
-    return False
+def get_default_alive_string(default_alive: Optional[bool]) -> str:
+    if default_alive is None:
+        return f'unknown, as it neither runs out nor becomes profitable within {RUNWAY_HORIZON_MONTHS // 12} years'
+    return str(default_alive)
 
 def get_stripe_subscriptions_at_time(stripe_subscriptions: pd.DataFrame, dt: datetime) -> pd.DataFrame:
     return stripe_subscriptions[(stripe_subscriptions['start_date'] < dt) & ((stripe_subscriptions['end_date'].isna()) | (stripe_subscriptions['end_date'] >= dt))]
@@ -73,46 +423,77 @@ def get_stripe_subscriptions_at_time(stripe_subscriptions: pd.DataFrame, dt: dat
 def get_team_customers_at_time(team_customer_data: pd.DataFrame, dt: datetime) -> pd.DataFrame:
     return team_customer_data[(team_customer_data['start_date'] < dt) & (team_customer_data['end_date'] >= dt)]
 
-def get_revenue_and_customers_dataframe(stripe_subscriptions: pd.DataFrame, team_customer_data: pd.DataFrame, mrr_or_arr: Literal['MRR', 'ARR']) -> pd.DataFrame:    
-    start_date = (datetime.now() - timedelta(weeks=30)).replace(day=1)
-    end_date = datetime.now().replace(day=1)
-
-    times = []
-    stripe_revenues = []
-    stripe_subscription_count = []
-    teams_revenue = []
-    teams_subscription_count = []
-    total_revenue = []
-
-    for dt in rrule.rrule(rrule.MONTHLY, dtstart=start_date, until=end_date):
-        
-        stripe_subs = get_stripe_subscriptions_at_time(stripe_subscriptions, dt)
-        team_subs = get_team_customers_at_time(team_customer_data, dt)
-
-        times.append(dt)
-        stripe_revenues.append(stripe_subs['amount'].sum())
-        stripe_subscription_count.append(len(stripe_subs))
-        teams_revenue.append(team_subs['monthly_amount'].sum())
-        teams_subscription_count.append(len(team_subs))
-        total_revenue.append(stripe_revenues[-1] + teams_revenue[-1])
-
-    # We then append one more for the current date, so we can see the current revenue
+def get_active_count_and_amount_at_times(start_dates: pd.Series, end_dates: pd.Series, amounts: pd.Series, times: List[datetime], missing_end_is_active: bool=True) -> Tuple[np.ndarray, np.ndarray]:
+    # A row is active at time t when start_date < t <= end_date. A row with no end_date never ends,
+    # unless missing_end_is_active is False, in which case it is never active.
+    # The number active at t is the number of starts before t minus the number of ends before t.
+    # We get that for every t at once by sorting the starts and ends and binary searching them.
+    starts = pd.to_datetime(start_dates).to_numpy(dtype='datetime64[ns]')
+    ends = pd.to_datetime(end_dates).to_numpy(dtype='datetime64[ns]')
+    amounts = np.nan_to_num(amounts.to_numpy(dtype='float64'))
+
+    # Rows that end before they start are never active, and would break the subtraction below
+    has_end = ~np.isnat(ends)
+    valid = ~np.isnat(starts) & ((~has_end & missing_end_is_active) | (ends > starts))
+    starts, ends, amounts, has_end = starts[valid], ends[valid], amounts[valid], has_end[valid]
+
+    start_order = np.argsort(starts, kind='stable')
+    sorted_starts = starts[start_order]
+    started_amounts = np.concatenate([[0.0], np.cumsum(amounts[start_order])])
+
+    end_order = np.argsort(ends[has_end], kind='stable')
+    sorted_ends = ends[has_end][end_order]
+    ended_amounts = np.concatenate([[0.0], np.cumsum(amounts[has_end][end_order])])
+
+    times_array = pd.DatetimeIndex(times).to_numpy(dtype='datetime64[ns]')
+    num_started = np.searchsorted(sorted_starts, times_array, side='left')
+    num_ended = np.searchsorted(sorted_ends, times_array, side='left')
+
+    counts = num_started - num_ended
+    totals = started_amounts[num_started] - ended_amounts[num_ended]
+    return counts, totals
+
+REVENUE_GRANULARITIES = {
+    'Monthly': rrule.MONTHLY,
+    'Weekly': rrule.WEEKLY,
+    'Daily': rrule.DAILY,
+}
+
+def get_revenue_and_customers_dataframe(
+        stripe_subscriptions: pd.DataFrame, 
+        team_customer_data: pd.DataFrame, 
+        mrr_or_arr: Literal['MRR', 'ARR'], 
+        granularity: Literal['Monthly', 'Weekly', 'Daily']='Monthly',
+        all_time: bool=False
+    ) -> pd.DataFrame:    
     today = datetime.now()
-    if times[-1] != today:
-        stripe_subs = get_stripe_subscriptions_at_time(stripe_subscriptions, today)
-        team_subs = get_team_customers_at_time(team_customer_data, today)
+    if all_time:
+        first_start_date = min(pd.to_datetime(stripe_subscriptions['start_date']).min(), pd.to_datetime(team_customer_data['start_date']).min())
+        start_date = first_start_date.to_pydatetime().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    else:
+        start_date = (today - timedelta(weeks=30)).replace(day=1)
+    end_date = today.replace(day=1) if granularity == 'Monthly' else today
 
+    times = list(rrule.rrule(REVENUE_GRANULARITIES[granularity], dtstart=start_date, until=end_date))
+
+    # We then append one more for the current date, so we can see the current revenue
+    if len(times) == 0 or times[-1] != today:
         times.append(today)
-        stripe_revenues.append(stripe_subs['amount'].sum())
-        stripe_subscription_count.append(len(stripe_subs))
-        teams_revenue.append(team_subs['monthly_amount'].sum())
-        teams_subscription_count.append(len(team_subs))
-        total_revenue.append(stripe_revenues[-1] + teams_revenue[-1])
+
+    stripe_subscription_count, stripe_revenues = get_active_count_and_amount_at_times(
+        stripe_subscriptions['start_date'], stripe_subscriptions['end_date'], stripe_subscriptions['amount'], times
+    )
+    teams_subscription_count, teams_revenue = get_active_count_and_amount_at_times(
+        team_customer_data['start_date'], team_customer_data['end_date'], team_customer_data['monthly_amount'], times,
+        # Like get_team_customers_at_time, a team without an end date isn't counted
+        missing_end_is_active=False,
+    )
+    total_revenue = stripe_revenues + teams_revenue
 
     if mrr_or_arr == 'ARR':
-        stripe_revenues = list(map(lambda x: x * 12, stripe_revenues))
-        teams_revenue = list(map(lambda x: x * 12, teams_revenue))
-        total_revenue = list(map(lambda x: x * 12, total_revenue))
+        stripe_revenues = stripe_revenues * 12
+        teams_revenue = teams_revenue * 12
+        total_revenue = total_revenue * 12
 
     return pd.DataFrame({
         'time': times,
@@ -124,111 +505,277 @@ def get_revenue_and_customers_dataframe(stripe_subscriptions: pd.DataFrame, team
     })
 
 
-def get_retention_at_x_months(retention_data: pd.DataFrame, month_x: int) -> Dict[datetime, float]:
-    retention_in_month = {}
-    for _, row in retention_data.iterrows():
-        start_date: datetime = row['start_date']
-        initial_size = row['initial_size']
+def get_retention_long_format(retention_data: pd.DataFrame) -> pd.DataFrame:
+    # Turns the wide table, with one period_YYYY_MM_DD column per month, into one row per
+    # cohort and number of months since that cohort started
+    period_columns = [column for column in retention_data.columns if column.startswith('period_')]
+    long_format = retention_data[['start_date', 'initial_size'] + period_columns].melt(
+        id_vars=['start_date', 'initial_size'], var_name='period', value_name='count', ignore_index=False
+    )
 
-        month_x_date = start_date
-        for m in range(month_x):
-            month_x_date += timedelta(days=32)
-            month_x_date = month_x_date.replace(day=1)
+    cohort_start = pd.to_datetime(long_format['start_date'])
+    period_start = pd.to_datetime(long_format['period'].str[len('period_'):], format='%Y_%m_%d')
+    long_format['month_x'] = (period_start.dt.year - cohort_start.dt.year) * 12 + (period_start.dt.month - cohort_start.dt.month)
 
-        key = f'period_{month_x_date.strftime("%Y_%m_%d")}'
-        if key in row:
-            num_in_month = row[key]
-            retention_in_month[start_date] = num_in_month / initial_size
+    long_format = long_format[(long_format['month_x'] >= 0) & (long_format['month_x'] < len(retention_data))]
+    long_format = long_format.rename_axis('row').sort_values(by=['month_x', 'row'])
+    cohort_start = pd.to_datetime(long_format['start_date'])
 
-    return retention_in_month
+    return pd.DataFrame({
+        'Month X': long_format['month_x'].to_numpy(dtype='int64'),
+        'Start Date': cohort_start.dt.strftime("%Y_%m_%d").to_numpy(),
+        'Cohort Start': cohort_start.to_numpy(),
+        'Count': long_format['count'].to_numpy(),
+        'Percentage': (long_format['count'] / long_format['initial_size']).to_numpy(),
+    })
 
-def get_retention_dict(retention_data: pd.DataFrame, last_n_months) -> pd.DataFrame:
+def get_retention_dict(retention_long_format: pd.DataFrame, last_n_months) -> pd.DataFrame:
     n_months_ago = datetime.now() - timedelta(days=last_n_months*30)
-    values = []
-    for month_x in range(len(retention_data)):
-        retention_in_month = get_retention_at_x_months(retention_data, month_x)
-        for start_date, percent in retention_in_month.items():
-            if start_date > n_months_ago:
-                values.append((month_x, start_date.strftime("%Y_%m_%d"), percent))
-
-    return pd.DataFrame(values, columns=['Month X', 'Start Date', 'Percentage'])
-    
-def convert_notion_property_to_raw_value(value: Any) -> Union[str, int, float, bool]:
-    if not isinstance(value, dict) and np.isnan(value):
-        return np.NaN
-    elif isinstance(value, dict):
-        if value['type'] == 'title':
-            title_list = value['title']
-            if len(title_list) == 0:
-                return ''
-            else:
-                return title_list[0]['text']['content']
-        if value['type'] == 'rich_text':
-            final_str = ''
-            for t in value['rich_text']:
-                final_str += t['plain_text']
-
-            return final_str
-        elif value['type'] == 'number':
-            return value['number']
-        elif value['type'] == 'multi_select':
-            selected = []
-            for ms in value['multi_select']:
-                selected.append(ms['name'])
-            return ", ".join(selected)
-        elif value['type'] == 'select':
-            return value['select']['name']
-        elif value['type'] == 'date':
-            return pd.to_datetime(value['date']['start']).date()
-        elif value['type'] == 'people':
-            people_list = value['people']
-            if len(people_list) == 0:
-                return ''
-            else:
-                return people_list[0]['name']
-
-    return str(value)
-
-def convert_column_of_notion_properties_to_raw_values(column: pd.Series) -> pd.Series:
-    return column.apply(convert_notion_property_to_raw_value)
+    recent_retention = retention_long_format[retention_long_format['Cohort Start'] > n_months_ago]
+    return recent_retention[['Month X', 'Start Date', 'Percentage']].reset_index(drop=True)
     
+# How to read the value out of each type of Notion property. Anything else is shown as the raw property
+NOTION_PROPERTY_DECODERS: Dict[str, Callable[[Any], Any]] = {
+    'title': lambda title: title[0]['text']['content'] if len(title) > 0 else '',
+    'rich_text': lambda rich_text: ''.join(t['plain_text'] for t in rich_text),
+    'number': lambda number: number,
+    'select': lambda select: select['name'] if select is not None else None,
+    'multi_select': lambda multi_select: ", ".join(ms['name'] for ms in multi_select),
+    'date': lambda date: datetime.strptime(date['start'][:10], '%Y-%m-%d').date() if date is not None else None,
+    'people': lambda people: people[0]['name'] if len(people) > 0 else '',
+}
+
+def decode_notion_column(properties: List[Optional[Dict[str, Any]]], property_type: str) -> pd.Series:
+    decoder = NOTION_PROPERTY_DECODERS.get(property_type)
+    if decoder is None:
+        return pd.Series([str(p) if p is not None else np.nan for p in properties], dtype=object)
+
+    values = [decoder(p[property_type]) if p is not None else np.nan for p in properties]
+    return pd.Series(values, dtype='float64' if property_type == 'number' else object)
+
+@instrumentation.timed('notion_decode')
+def decode_notion_results(results: List[Dict[str, Any]], schema: Dict[str, str]) -> pd.DataFrame:
+    # We look up the decoder once per property from the schema, rather than checking the type of every cell
+    return pd.DataFrame({
+        name: decode_notion_column([result['properties'].get(name) for result in results], property_type)
+        for name, property_type in schema.items()
+    })
 
-def get_notion_database(database_id: str, properties_only=True) -> pd.DataFrame:
+# Once the database is cached, we check Notion for edited pages at most this often. Deleted and archived 
+# pages never come back from an incremental query, so we also reload the whole database every so often
+NOTION_SYNC_INTERVAL_SECONDS = int(os.environ.get('NOTION_SYNC_INTERVAL_SECONDS', 60))
+NOTION_FULL_SYNC_INTERVAL_SECONDS = int(os.environ.get('NOTION_FULL_SYNC_INTERVAL_SECONDS', 60 * 60))
+
+class NotionDatabaseCache(TypedDict):
+    lock: threading.Lock
+    schema: Dict[str, str]
+    pages: Dict[str, Dict[str, Any]]
+    watermark: Optional[str]
+    synced_at: float
+    fully_synced_at: float
+    properties: Optional[pd.DataFrame]
+
+NOTION_API_URL = os.environ.get('NOTION_API_URL', 'https://api.notion.com/v1/')
 
-    headers = {
+def get_notion_headers() -> Dict[str, str]:
+    return {
         "Authorization": "Bearer " + get_secret('NOTION_API_KEY'),
         "Content-Type": "application/json",
-        "Notion-Version": "2021-05-13"
+        "Notion-Version": "2022-06-28"
     }
 
-    url = f"https://api.notion.com/v1/databases/{database_id}/query"
+def get_notion_database_schema(database_id: str) -> Dict[str, str]:
+    url = f"{NOTION_API_URL}databases/{database_id}"
 
-    res = requests.request("POST", url, headers=headers)
+    res = http_client.request("GET", url, endpoint='notion databases', headers=get_notion_headers())
     data = res.json()
 
-    results = pd.DataFrame(data['results'])
-    if properties_only:
-        properties_df = pd.DataFrame(list(results['properties']))
-        return properties_df.apply(lambda col: convert_column_of_notion_properties_to_raw_values(col), axis=1)
+    return {name: notion_property['type'] for name, notion_property in data['properties'].items()}
+
+def query_notion_database(database_id: str, filter: Optional[Dict[str, Any]]=None) -> List[Dict[str, Any]]:
+    url = f"{NOTION_API_URL}databases/{database_id}/query"
+
+    body: Dict[str, Any] = {'page_size': 100}
+    if filter is not None:
+        body['filter'] = filter
+
+    results = []
+    while True:
+        res = http_client.request("POST", url, endpoint='notion databases query', headers=get_notion_headers(), json=body)
+        data = res.json()
+        results.extend(data['results'])
+
+        if not data.get('has_more'):
+            return results
+        body['start_cursor'] = data['next_cursor']
+
+@st.cache_resource
+def get_notion_database_cache(database_id: str) -> NotionDatabaseCache:
+    return {
+        'lock': threading.Lock(), 
+        'schema': {}, 
+        'pages': {}, 
+        'watermark': None, 
+        'synced_at': 0, 
+        'fully_synced_at': 0, 
+        'properties': None
+    }
+
+def sync_notion_database(cache: NotionDatabaseCache, database_id: str) -> None:
+    now = time.time()
+    if now - cache['fully_synced_at'] >= NOTION_FULL_SYNC_INTERVAL_SECONDS:
+        cache['schema'] = get_notion_database_schema(database_id)
+        cache['pages'] = {}
+        cache['properties'] = None
+        cache['fully_synced_at'] = now
+        changed_pages = query_notion_database(database_id)
+    elif now - cache['synced_at'] >= NOTION_SYNC_INTERVAL_SECONDS:
+        # last_edited_time is rounded to the minute, so we ask for everything edited on or after 
+        # the watermark, and replace any pages we already have
+        changed_pages = query_notion_database(
+            database_id, 
+            {'timestamp': 'last_edited_time', 'last_edited_time': {'on_or_after': cache['watermark']}} if cache['watermark'] is not None else None
+        )
     else:
-        return results
+        return
 
+    cache['synced_at'] = now
+    # The incremental query always returns the pages edited at the watermark again, so only pages that
+    # are new or differ from our copy mean the decoded frame is out of date
+    changed_pages = [page for page in changed_pages if cache['pages'].get(page['id']) != page]
+    if len(changed_pages) == 0 and cache['properties'] is not None:
+        return
 
-st.title('Mito Company Dashboard')
+    for page in changed_pages:
+        cache['pages'][page['id']] = page
+    cache['watermark'] = max((page['last_edited_time'] for page in cache['pages'].values()), default=None)
+    cache['properties'] = None
 
-revenue_tab, expense_tab, mixpanel_tab, website_traffic_tab, growth_tab, sales_tab, support_tab = st.tabs(["Revenue", "Expenses", "Mixpanel", "Website Traffic", "Growth", "Sales", "Support"])
+def get_notion_database(database_id: str, properties_only=True) -> pd.DataFrame:
+    cache = get_notion_database_cache(database_id)
+    with cache['lock']:
+        sync_notion_database(cache, database_id)
+
+        if not properties_only:
+            return pd.DataFrame(list(cache['pages'].values()))
+
+        if cache['properties'] is None:
+            cache['properties'] = decode_notion_results(list(cache['pages'].values()), cache['schema'])
+            cache['properties'].attrs['loaded_at'] = time.time()
+        return cache['properties'].copy()
+
+
+def get_recent_revenue() -> pd.DataFrame:
+    # We only look at recent revenue, and transactions under a million dollars, to avoid investment
+    return get_snowflake_table_as_df(
+        'BREX', 'TRANSACTION_DATA', 
+        columns=('id', 'description', 'amount', 'currency', 'initiated_at_date', 'posted_at_date', 'month'),
+        filters=(('amount', '>=', 0), ('amount', 'abs <', 1_000_000)),
+        date_range=('initiated_at_date', date(2022, 10, 1), None),
+    )
 
-with revenue_tab:
-    brex_transaction_data = get_snowflake_table_as_df('BREX', 'TRANSACTION_DATA')
-    brex_transaction_data = brex_transaction_data[brex_transaction_data['amount'].abs() < 1_000_000]
-    brex_account_data = get_snowflake_table_as_df('BREX', 'ACCOUNT_DATA')
-    team_customer_data = get_snowflake_table_as_df('TEAMS', 'CUSTOMERS')
-    stripe_subscriptions = get_snowflake_table_as_df('STRIPE', 'SUBSCRIPTIONS')
+def get_monthly_finance_table(table: str, ascending: bool) -> pd.DataFrame:
+    # These are rolled up from BREX.TRANSACTION_DATA by the loader, one row per month
+    return get_snowflake_table_as_df('BREX', table).sort_values(by='month', ascending=ascending).reset_index(drop=True)
+
+DATA_SOURCES: Dict[str, Callable[[], pd.DataFrame]] = {
+    'Recent Income': get_recent_revenue,
+    'Monthly Income': lambda: get_monthly_finance_table('MONTHLY_INCOME', ascending=False),
+    'Monthly Income By Source': lambda: get_monthly_finance_table('MONTHLY_INCOME_BY_SOURCE', ascending=False).rename(columns={'short_description': 'short description'}),
+    'Monthly Stripe Revenue': lambda: get_monthly_finance_table('MONTHLY_STRIPE_REVENUE', ascending=True),
+    'Monthly Expenses': lambda: get_monthly_finance_table('MONTHLY_EXPENSES', ascending=True),
+    'Monthly Payroll': lambda: get_monthly_finance_table('MONTHLY_PAYROLL', ascending=True),
+    'Brex Accounts': lambda: get_snowflake_table_as_df('BREX', 'ACCOUNT_DATA'),
+    'Team Customers': lambda: get_snowflake_table_as_df('TEAMS', 'CUSTOMERS'),
+    'Stripe Subscriptions': lambda: get_snowflake_table_as_df('STRIPE', 'SUBSCRIPTIONS'),
+    'Mixpanel Signups': lambda: get_snowflake_table_as_df('MIXPANEL', 'SIGNUPS'),
+    'Mixpanel Retention': lambda: get_snowflake_table_as_df('MIXPANEL', 'RETENTION'),
+    'Partnered Content': lambda: get_notion_database('5d5c87d7503b47a3a9622957d6ac7918'),
+    'Partnered Content Reach Outs': lambda: get_notion_database('13cfd90e7d47466a85003f78d3054d0e'),
+    'Blog Content Promotion': lambda: get_notion_database('ff34057e55c842799b71f775d105c701'),
+    'Outreach Tracker': lambda: get_notion_database('39d86e3f7e374c8da71e8285df26d955'),
+    'Support Tracker': lambda: get_notion_database('e68d246aca5c4262b1df7095ccecb78e'),
+    'Use Case Tracker': lambda: get_notion_database('50291dfbbf8d4799ae14120185068a34'),
+}
+
+PREFETCH_MAX_WORKERS = int(os.environ.get('PREFETCH_MAX_WORKERS', 8))
+
+@st.cache_resource
+def get_prefetch_executor() -> ThreadPoolExecutor:
+    # Shared by every session, so the number of requests in flight stays bounded
+    return ThreadPoolExecutor(max_workers=PREFETCH_MAX_WORKERS)
+
+def prefetch_data_sources(source_names: List[str]) -> Dict[str, 'Future[pd.DataFrame]']:
+    ctx = get_script_run_ctx()
+
+    def load(source_name: str) -> pd.DataFrame:
+        # Lets the worker thread use st.secrets and the st caches on behalf of this session
+        add_script_run_ctx(threading.current_thread(), ctx)
+        with instrumentation.measure('data_source', source_name) as measurement:
+            df = DATA_SOURCES[source_name]()
+            measurement.update(instrumentation.describe_result(df)) # type: ignore
+        return df
+
+    # Loads still in flight from earlier in the session are reused rather than started again.
+    # Finished ones are started again, which is a cache hit unless the data has changed
+    in_flight: Dict[str, 'Future[pd.DataFrame]'] = st.session_state.setdefault('data_source_futures', {})
+    executor = get_prefetch_executor()
+    for source_name in source_names:
+        if source_name not in in_flight or in_flight[source_name].done():
+            in_flight[source_name] = executor.submit(load, source_name)
+
+    return {source_name: in_flight[source_name] for source_name in source_names}
+
+def get_data_version(*dfs: pd.DataFrame) -> Tuple[Optional[float], ...]:
+    # Sources are stamped when they are actually read, so this changes exactly when the data does
+    return tuple(df.attrs.get('loaded_at') for df in dfs)
+
+def render_tab(render: Callable[..., None], data_sources: Dict[str, 'Future[pd.DataFrame]'], *source_names: str) -> None:
+    # A source that fails to load only takes down the tabs that need it
+    dfs = []
+    for source_name in source_names:
+        try:
+            dfs.append(data_sources[source_name].result())
+        except Exception as e:
+            st.error(f'Could not load {source_name}: {e}')
+            return
+
+    # As a fragment, changing a widget in this tab reruns only this tab, with the data it already has
+    st.fragment(instrumentation.timed('tab')(render))(*dfs)
+
+
+@instrumentation.timed('compute', cached=True)
+@st.cache_data(show_spinner=False, max_entries=64)
+def compute_revenue_chart(_stripe_subscriptions: pd.DataFrame, _team_customer_data: pd.DataFrame, data_version: Tuple, mrr_or_arr: Literal['MRR', 'ARR'], granularity: Literal['Monthly', 'Weekly', 'Daily'], all_time: bool) -> pd.DataFrame:
+    instrumentation.note_cache_miss()
+    return get_revenue_and_customers_dataframe(_stripe_subscriptions, _team_customer_data, mrr_or_arr, granularity, all_time)
+
+@instrumentation.timed('compute', cached=True)
+@st.cache_data(show_spinner=False, max_entries=8)
+def compute_revenue_summaries(_team_customer_data: pd.DataFrame, _stripe_subscriptions: pd.DataFrame, data_version: Tuple) -> Dict[str, pd.DataFrame]:
+    instrumentation.note_cache_miss()
+    return {
+        'current_team_customers': _team_customer_data[_team_customer_data['end_date'] >= datetime.now()],
+        'revenue_per_month': get_revenue_and_customers_dataframe(_stripe_subscriptions, _team_customer_data, 'MRR'),
+    }
 
+def render_revenue_tab(
+        recent_revenue: pd.DataFrame, 
+        team_customer_data: pd.DataFrame, 
+        stripe_subscriptions: pd.DataFrame, 
+        monthly_income: pd.DataFrame, 
+        monthly_income_by_source: pd.DataFrame, 
+        monthly_stripe_revenue: pd.DataFrame
+    ) -> None:
     st.header('Revenue')
 
     mrr_or_arr: Literal['MRR', 'ARR'] = st.selectbox('MRR or ARR', ['MRR', 'ARR']) # type: ignore
-    revenue_per_month = get_revenue_and_customers_dataframe(stripe_subscriptions, team_customer_data, mrr_or_arr)
+    revenue_granularity: Literal['Monthly', 'Weekly', 'Daily'] = st.selectbox('Granularity', list(REVENUE_GRANULARITIES.keys())) # type: ignore
+    revenue_all_time = st.checkbox('All Time', value=False)
+    revenue_per_month = compute_revenue_chart(
+        stripe_subscriptions, team_customer_data, get_data_version(stripe_subscriptions, team_customer_data), 
+        mrr_or_arr, revenue_granularity, revenue_all_time
+    )
     st.plotly_chart(
         px.bar(
             revenue_per_month, x='time', y=['stripe_revenue', 'team_revenue', 'total_revenue'], 
@@ -237,45 +784,30 @@ with revenue_tab:
         )
     )
 
-    # We only look at recent revenue to avoid investment
-    recent_revenue = brex_transaction_data[(brex_transaction_data['amount'] >= 0) & (brex_transaction_data['initiated_at_date'] >= pd.to_datetime('2022-10-01'))]
-    st.dataframe(recent_revenue)
-
-    recent_revenue_summed = recent_revenue.groupby('month').sum(numeric_only=True).reset_index().sort_values(by='month', ascending=False)
-    st.plotly_chart(px.bar(recent_revenue_summed, x='month', y='amount', title='Actual Income (Money Entering Bank Account)'))
+    summaries = compute_revenue_summaries(
+        team_customer_data, stripe_subscriptions, 
+        get_data_version(team_customer_data, stripe_subscriptions)
+    )
 
-    # Split description at the -, and take before it
-    recent_revenue['short description'] = recent_revenue['description'].apply(lambda x: x.split('-')[0])
-    # Look at revenue per month, per short description
-    recent_revenue_summed_by_short_description = recent_revenue.groupby(['month', 'short description']).sum(numeric_only=True).reset_index().sort_values(by='month', ascending=False)
-    st.plotly_chart(px.bar(recent_revenue_summed_by_short_description, x='month', y='amount', color='short description', title='Actual Income (Money Entering Bank Account)'))
+    st.dataframe(recent_revenue)
+    st.plotly_chart(px.bar(monthly_income, x='month', y='amount', title='Actual Income (Money Entering Bank Account)'))
+    st.plotly_chart(px.bar(monthly_income_by_source, x='month', y='amount', color='short description', title='Actual Income (Money Entering Bank Account)'))
 
     st.header("Revenue Breakdown")
 
-    current_team_customers = team_customer_data[team_customer_data['end_date'] >= datetime.now()]
-    current_teams_revenue = current_team_customers['monthly_amount'].sum()
-
     st.subheader("Revenue and Subscribers Over Time")
-    revenue_per_month = get_revenue_and_customers_dataframe(stripe_subscriptions, team_customer_data, 'MRR')
-    st.dataframe(revenue_per_month)
+    st.dataframe(summaries['revenue_per_month'])
     
     st.subheader('Current Teams')
-    st.dataframe(current_team_customers)
+    st.dataframe(summaries['current_team_customers'])
 
     st.subheader('Revenue from Stripe')
-    stripe_revenue = brex_transaction_data[(brex_transaction_data['amount'] >= 0) & (brex_transaction_data['description'] == 'STRIPE - TRANSFER')]
-    st.plotly_chart(px.bar(stripe_revenue, x='month', y='amount', title='Revenue from Stripe'))
+    st.plotly_chart(px.bar(monthly_stripe_revenue, x='month', y='amount', title='Revenue from Stripe'))
 
 
-with expense_tab:
-    expenses = brex_transaction_data[brex_transaction_data['amount'] < 0].copy()
-    expenses['amount'] = expenses['amount'] * -1
-    summed_expenses = expenses.groupby('month').sum(numeric_only=True).reset_index()
+def render_expense_tab(summed_expenses: pd.DataFrame, summed_payroll_expenses: pd.DataFrame, recent_revenue_summed: pd.DataFrame, brex_account_data: pd.DataFrame) -> None:
     st.plotly_chart(px.bar(summed_expenses, x='month', y='amount', title='Expenses'))
 
-    payroll_expenses = brex_transaction_data[(brex_transaction_data['amount'] < 0) & (brex_transaction_data['description'].str.contains('RIPPLING'))].copy()
-    payroll_expenses['amount'] = payroll_expenses['amount'] * -1
-    summed_payroll_expenses = payroll_expenses.groupby('month').sum(numeric_only=True).reset_index()
     st.plotly_chart(px.bar(summed_payroll_expenses, x='month', y='amount', title='Payroll Expenses'))
 
     st.plotly_chart(px.line(brex_account_data, x='start_date', y='start_balance', title='Money in Bank All Time'))
@@ -300,7 +832,7 @@ with expense_tab:
     min_revenue = recent_revenue_summed['amount'].min()
     max_revenue = recent_revenue_summed['amount'].max()
     avg_revenue = recent_revenue_summed['amount'].mean()
-    summed_expenses = expenses.groupby('month').sum(numeric_only=True).reset_index().sort_values(by='month', ascending=False).head(number_months)
+    summed_expenses = summed_expenses.sort_values(by='month', ascending=False).head(number_months)
     min_gross_burn = summed_expenses['amount'].min() + salary_adjustment
     max_gross_burn = summed_expenses['amount'].max() + salary_adjustment
     avg_gross_burn = summed_expenses['amount'].mean() + salary_adjustment
@@ -314,9 +846,28 @@ with expense_tab:
     avg_case_default_alive = get_is_default_alive(balance, avg_revenue, avg_gross_burn, revenue_growth_rate)
     best_case_default_alive = get_is_default_alive(balance, max_revenue, min_gross_burn, revenue_growth_rate)
 
-    st.text(f'Worst case default alive: {worst_case_default_alive}')
-    st.text(f'Average case default alive: {avg_case_default_alive}')
-    st.text(f'Best case default alive: {best_case_default_alive}')
+    st.text(f'Worst case default alive: {get_default_alive_string(worst_case_default_alive)}')
+    st.text(f'Average case default alive: {get_default_alive_string(avg_case_default_alive)}')
+    st.text(f'Best case default alive: {get_default_alive_string(best_case_default_alive)}')
+
+    st.subheader('Runway Sensitivity')
+    st.write(f'Months until the money runs out, for every combination of monthly revenue and gross burn between the best and worst of the last {number_months} months. Blank cells never run out, and cells at {RUNWAY_HORIZON_MONTHS} neither run out nor become profitable within {RUNWAY_HORIZON_MONTHS // 12} years.')
+
+    revenues = np.linspace(min_revenue, max_revenue, 25)
+    gross_burns = np.linspace(min_gross_burn, max_gross_burn, 25) - salary_adjustment
+    revenue_growth_rates = sorted({0, revenue_growth_rate / 2, revenue_growth_rate, revenue_growth_rate * 2})
+    runway_scenarios = get_runway_scenarios(balance, revenues, gross_burns, revenue_growth_rates, [salary_adjustment])
+
+    # Anything that lasts past the horizon, or might, is drawn at the horizon, so it doesn't stretch the colour scale
+    months_to_zero = runway_scenarios['months_to_zero']
+    months_to_zero = months_to_zero.fillna(RUNWAY_HORIZON_MONTHS).clip(upper=RUNWAY_HORIZON_MONTHS).where(~np.isinf(months_to_zero))
+    months_to_zero = months_to_zero.to_numpy().reshape(len(revenues), len(gross_burns), len(revenue_growth_rates))
+    heatmap = px.imshow(
+        months_to_zero.transpose(2, 1, 0), x=revenues, y=gross_burns, facet_col=0, facet_col_wrap=2,
+        labels={'x': 'Monthly Revenue', 'y': 'Gross Burn', 'color': 'Months to Zero'}, aspect='auto', origin='lower',
+    )
+    heatmap.for_each_annotation(lambda annotation: annotation.update(text=f"Growth: {revenue_growth_rates[int(annotation.text.split('=')[-1])]:.2%}"))
+    st.plotly_chart(heatmap)
 
 
     st.text("Balance at end of last statement: {:,}".format(balance))
@@ -332,10 +883,14 @@ with expense_tab:
     st.text(f'Average gross burn in the last {number_months} months: {get_runway_string(balance, avg_gross_burn)}')
 
 
-with mixpanel_tab:
+@instrumentation.timed('compute', cached=True)
+@st.cache_data(show_spinner=False, max_entries=8)
+def compute_retention_long_format(_mixpanel_retention_data: pd.DataFrame, data_version: Tuple) -> pd.DataFrame:
+    instrumentation.note_cache_miss()
+    return get_retention_long_format(_mixpanel_retention_data)
+
+def render_mixpanel_tab(mixpanel_signup_data: pd.DataFrame, mixpanel_retention_data: pd.DataFrame) -> None:
     st.header("Mixpanel Data")
-    mixpanel_signup_data = get_snowflake_table_as_df('MIXPANEL', 'SIGNUPS')
-    mixpanel_retention_data = get_snowflake_table_as_df('MIXPANEL', 'RETENTION')
     
     # Mixpanel things
     st.subheader('Signup Data')
@@ -344,26 +899,24 @@ with mixpanel_tab:
     st.plotly_chart(px.line(mixpanel_signup_data, x='month', y='install_success_rate', title='Install Success Rate'))
 
     st.subheader('Retention Data')
+    retention_long_format = compute_retention_long_format(mixpanel_retention_data, get_data_version(mixpanel_retention_data))
     last_n_months = st.slider('Last N Months:', min_value=1, max_value=len(mixpanel_retention_data))
-    retention_data = get_retention_dict(mixpanel_retention_data, last_n_months)
+    retention_data = get_retention_dict(retention_long_format, last_n_months)
     st.plotly_chart(px.line(retention_data, x='Month X', y='Percentage', color='Start Date', title='Retention'))
     during_month = st.slider('Raw Retention Data During Month:', min_value=1, max_value=len(mixpanel_retention_data))
-    all_retention_data = get_retention_dict(mixpanel_retention_data, len(mixpanel_retention_data))
+    all_retention_data = get_retention_dict(retention_long_format, len(mixpanel_retention_data))
     st.dataframe(all_retention_data[all_retention_data['Month X'] == during_month])
 
-with website_traffic_tab:
+
+def render_website_traffic_tab() -> None:
     st.header('Website Traffic')
 
     st.components.v1.iframe(get_secret('PLAUSIBLE_TRYMITO_DASHBOARD'), height=2800)
     st.components.v1.iframe(get_secret('PLAUSIBLE_TRYMITO_BLOG_DASHBOARD'), height=2800)
 
 
-with growth_tab:
-
-    partnered_content = get_notion_database('5d5c87d7503b47a3a9622957d6ac7918')
+def render_growth_tab(partnered_content: pd.DataFrame, partnered_content_reach_outs: pd.DataFrame, blog_promotion_content: pd.DataFrame) -> None:
     partnered_content = partnered_content[partnered_content['Post'] != '']
-    partnered_content_reach_outs = get_notion_database('13cfd90e7d47466a85003f78d3054d0e')
-    blog_promotion_content = get_notion_database('ff34057e55c842799b71f775d105c701')
 
     # Allow the users to see growth tasks in a specific range
     today = datetime.today()
@@ -390,10 +943,8 @@ with growth_tab:
     st.subheader(f'Partnered Content Reach Outs')
     st.dataframe(partnered_content_reach_outs)
 
-with sales_tab:
-
-    outreach_tracker = get_notion_database('39d86e3f7e374c8da71e8285df26d955')
 
+def render_sales_tab(outreach_tracker: pd.DataFrame) -> None:
     # Allow the users to see growth tasks in a specific range
     today = datetime.today()
     one_week_ago = today - timedelta(days=7)
@@ -407,10 +958,8 @@ with sales_tab:
     st.header('All Outreach')
     st.dataframe(outreach_tracker)
 
-with support_tab:
 
-    support_tracker = get_notion_database('e68d246aca5c4262b1df7095ccecb78e')
-    use_case_tracker = get_notion_database('50291dfbbf8d4799ae14120185068a34')
+def render_support_tab(support_tracker: pd.DataFrame, use_case_tracker: pd.DataFrame) -> None:
 
     def get_support_pivot(support_df, column_name):
         # Pivoted support_tracker into support_tracker_pivot
@@ -444,4 +993,45 @@ with support_tab:
     st.header('All Support')
     st.dataframe(support_tracker)
     st.header('All Use Cases')
-    st.dataframe(use_case_tracker)
\ No newline at end of file
+    st.dataframe(use_case_tracker)
+
+
+TABS: Dict[str, Tuple[Callable[..., None], List[str]]] = {
+    'Revenue': (render_revenue_tab, ['Recent Income', 'Team Customers', 'Stripe Subscriptions', 'Monthly Income', 'Monthly Income By Source', 'Monthly Stripe Revenue']),
+    'Expenses': (render_expense_tab, ['Monthly Expenses', 'Monthly Payroll', 'Monthly Income', 'Brex Accounts']),
+    'Mixpanel': (render_mixpanel_tab, ['Mixpanel Signups', 'Mixpanel Retention']),
+    'Website Traffic': (render_website_traffic_tab, []),
+    'Growth': (render_growth_tab, ['Partnered Content', 'Partnered Content Reach Outs', 'Blog Content Promotion']),
+    'Sales': (render_sales_tab, ['Outreach Tracker']),
+    'Support': (render_support_tab, ['Support Tracker', 'Use Case Tracker']),
+}
+
+
+# Streamlit runs this file as __main__, so the functions above can also be imported, like benchmark.py does
+if __name__ == '__main__':
+    st.title('Mito Company Dashboard')
+
+    if st.sidebar.button('Refresh Data'):
+        invalidate_snowflake_table()
+        get_notion_database_cache.clear()
+
+    # The first time a session loads, start loading every source in the background, 
+    # so switching to another tab later doesn't wait on the network
+    if 'data_source_futures' not in st.session_state:
+        prefetch_data_sources(list(DATA_SOURCES.keys()))
+
+    # Only the selected tab is run, and it only waits on the sources it needs
+    selected_tab = st.radio('Tab', list(TABS.keys()), horizontal=True, label_visibility='collapsed')
+    render, source_names = TABS[selected_tab]
+    render_tab(render, prefetch_data_sources(source_names), *source_names)
+
+    # A tab rendered from a stale snapshot is redrawn once the background refresh brings newer data
+    rerun_on_new_snowflake_snapshots()
+
+    # Everything this server process has timed, so a slow rerun can be pinned on a source, a computation or a tab
+    with st.expander('Performance'):
+        measurements = instrumentation.get_measurements()
+        st.caption(f'The last {len(measurements)} timed operations across every session. Changing a widget inside a tab does not refresh this panel.')
+        st.dataframe(instrumentation.summarize_measurements(measurements), hide_index=True)
+        st.subheader('Most Recent')
+        st.dataframe(pd.DataFrame(measurements[-50:][::-1]), hide_index=True)